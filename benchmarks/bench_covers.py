@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+bench_covers
+------------
+在本地启动一个模拟搜索结果页和封面图片的HTTP服务器（每个请求延迟 latency 毫秒，
+模拟网络往返），测量 fetch_covers 获取封面的速度：单线程与 COVER_WORKERS 个线程。
+
+    python benchmarks/bench_covers.py              # 200 本书，延迟 20ms
+    python benchmarks/bench_covers.py -b 1000 -l 50
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+from cover import fetch_covers  # noqa: E402
+from db import connect  # noqa: E402
+from utils import init_schema  # noqa: E402
+
+# 搜索结果页中只需要 cover._search 用到的结构
+_RESULTS = ('<html><body><div id="resultsCol"><ul>'
+            '<li><img src="http://{host}/img/{num}._AA100_.jpg"></li>'
+            '</ul></div></body></html>')
+_IMAGE = b'\xff\xd8\xff\xe0' + b'\0' * 8 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path.startswith('/img/'):
+            body, ctype = _IMAGE, 'image/jpeg'
+        else:
+            body = _RESULTS.format(host=self.headers['Host'],
+                                   num=abs(hash(self.path))).encode('utf-8')
+            ctype = 'text/html; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _config(folder, port, workers):
+    return {
+        'COVER_SEARCH_URL': 'http://127.0.0.1:{}/s?k='.format(port),
+        'COVERPIC_FOLDER': os.path.join(folder, 'pics'),
+        'COVER_WORKERS': workers,
+        'COVER_TIMEOUT': 10,
+        'COVER_RETRY_BASE': config.COVER_RETRY_BASE,
+        'COVER_RETRY_MAX': config.COVER_RETRY_MAX,
+        'USER_AGENT': config.USER_AGENT,
+    }
+
+
+def run(books=200, latency=20, workers=None):
+    """返回单线程与多线程获取 books 本书的封面的速度。"""
+    workers = workers or config.COVER_WORKERS
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.latency = latency / 1000
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    folder = tempfile.mkdtemp(prefix='clindle_bench_')
+    results = {'books': books, 'latency': latency}
+    try:
+        for name, num in (('serial', 1), ('threaded', workers)):
+            conn = connect(os.path.join(folder, name + '.db'))
+            init_schema(conn)
+            conn.executemany(
+                'insert into Books(title, titlekey) values(?, ?);',
+                (('书{}'.format(i), str(i)) for i in range(books)))
+            conn.commit()
+            start = time.perf_counter()
+            found, failed = fetch_covers(
+                conn, _config(folder, server.server_port, num))
+            seconds = time.perf_counter() - start
+            conn.close()
+            assert (found, failed) == (books, 0), (found, failed)
+            results[name] = {'workers': num, 'seconds': round(seconds, 3),
+                             'books_per_sec': round(books / seconds, 1)}
+        results['threaded']['speedup'] = round(
+            results['threaded']['books_per_sec'] /
+            results['serial']['books_per_sec'], 2)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(folder)
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Benchmark cover fetching against a local stub server.')
+    argp.add_argument('-b', '--books', type=int, default=200)
+    argp.add_argument('-l', '--latency', type=int, default=20,
+                      help='模拟的每个请求的延迟（毫秒）')
+    argp.add_argument('-w', '--workers', type=int,
+                      help='覆盖 COVER_WORKERS')
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    results = run(args.books, args.latency, args.workers)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{books} books, {latency} ms latency'.format(**results))
+    for name in ('serial', 'threaded'):
+        result = dict({'speedup': 1}, **results[name])
+        print('{:<8} {workers:>3} workers  {seconds:>8.3f} s  '
+              '{books_per_sec:>8} books/s  {speedup:>5}x'.format(
+                  name, **result))
+
+
+if __name__ == '__main__':
+    main()
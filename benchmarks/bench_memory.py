@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+bench_memory
+------------
+用 tracemalloc 测量把整个文件解析到内存中（ClipsParser.parse() 保存的字典）时
+Python 分配的内存峰值，以及解析结束后仍然占用的内存：
+- legacy: 之前的表示方式，{bookname: {十六进制md5: 有六个键的字典}}，
+  由 bench_parser.LegacyParser 解析得到（输出与 ClipsParser 相同）；
+- compact: ClipsParser._parseclips() 得到的 {bookname: {16字节md5: Clip}}；
+- stream: 流式解析（iter_clips()，不保存结果）的峰值，与文件大小无关。
+tracemalloc 会让解析慢几倍，这里只比较内存，不比较速度。
+
+    python benchmarks/bench_memory.py              # 100,000 条记录
+    python benchmarks/bench_memory.py -n 1000000 --no-legacy
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_parser import LegacyParser  # noqa: E402
+from kindle_parser import ClipsParser  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+
+def _legacy(path):
+    book_clips = defaultdict(dict)
+    for bookname, index, book_clip in LegacyParser(path).iter_clips():
+        book_clips[bookname].update({index: book_clip})
+    return book_clips
+
+
+def _compact(path):
+    parser = ClipsParser(path, workers=1)
+    return parser._parseclips(parser.iter_clips())
+
+
+def _stream(path):
+    deque(ClipsParser(path, workers=1).iter_clips(), maxlen=0)
+
+
+def _measure(func, path):
+    """返回 (结果中的记录数, 峰值字节数, 结束后仍占用的字节数)。"""
+    tracemalloc.start()
+    try:
+        result = func(path)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    clips = sum(map(len, result.values())) if result else 0
+    return clips, peak, current
+
+
+def run(path, legacy=True):
+    """返回各种表示方式的内存峰值；legacy 为 False 时不测之前的方式。"""
+    funcs = [('compact', _compact), ('stream', _stream)]
+    if legacy:
+        funcs.insert(0, ('legacy', _legacy))
+    results = {}
+    for name, func in funcs:
+        clips, peak, current = _measure(func, path)
+        results[name] = {'peak_bytes': peak, 'retained_bytes': current}
+        if clips:
+            results[name].update(clips=clips,
+                                 peak_bytes_per_clip=round(peak / clips))
+    if legacy:
+        results['compact']['peak_reduction'] = round(
+            1 - results['compact']['peak_bytes'] /
+            results['legacy']['peak_bytes'], 3)
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Measure peak memory of parsing a whole clippings file.')
+    argp.add_argument('-n', '--clips', type=int, default=100000)
+    argp.add_argument('-f', '--file', help='已有的或要生成的文件，'
+                      '默认在临时目录中按记录数生成一次并重复使用')
+    argp.add_argument('--no-legacy', dest='legacy', action='store_false',
+                      help='不测之前的表示方式（较慢）')
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    path = args.file or os.path.join(
+        tempfile.gettempdir(), 'clindle_bench_{}.txt'.format(args.clips))
+    if not os.path.exists(path):
+        generate(path, args.clips)
+    results = run(path, args.legacy)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name in ('legacy', 'compact', 'stream'):
+        if name not in results:
+            continue
+        result = results[name]
+        print('{:<8} peak {:>9.1f} MB  retained {:>9.1f} MB  {}'.format(
+            name, result['peak_bytes'] / 2 ** 20,
+            result['retained_bytes'] / 2 ** 20,
+            '{} B/clip'.format(result['peak_bytes_per_clip'])
+            if 'clips' in result else ''))
+    if 'peak_reduction' in results['compact']:
+        print('compact peak is {:.1%} lower than legacy'.format(
+            results['compact']['peak_reduction']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+bench_pages
+-----------
+用 Flask 测试客户端测量书籍列表和书籍页面的响应时间：第一页和最后一页
+（按页码直接跳转，走 limit/offset），分别在不使用和使用页面缓存时各请求若干次。
+数据库由合成数据写入临时目录，不会修改 data/ 中的数据库。
+
+    python benchmarks/bench_pages.py              # 100,000 条记录
+    python benchmarks/bench_pages.py -n 10000 -r 500
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from db import get_pool  # noqa: E402
+from kindle_parser import ClipsParser  # noqa: E402
+from synthetic import generate  # noqa: E402
+from utils import save2db  # noqa: E402
+
+
+def _app(folder):
+    """创建应用，数据文件都指向 folder。"""
+    import clindle
+    return clindle.create_app({
+        name: os.path.join(folder, name)
+        for name in ('DATABASE', 'COVERPIC_FOLDER', 'SNAPSHOT_FILE')})
+
+
+def _timeit(client, url, requests):
+    """返回平均每次请求的毫秒数。"""
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+    return round((time.perf_counter() - start) / requests * 1000, 3)
+
+
+def run(path, requests=200):
+    """返回各页面不使用缓存和使用缓存时的平均响应时间（毫秒）。"""
+    folder = tempfile.mkdtemp(prefix='clindle_bench_')
+    try:
+        app = _app(folder)
+        cache = app.extensions['clindle_cache']
+        database = app.config['DATABASE']
+        error = save2db(ClipsParser(path).iter_clips(), database=database)
+        assert error is None, error
+        cache.bump()
+
+        with get_pool(database).connection() as conn:
+            book_count = conn.execute(
+                'select count(*) from Books;').fetchone()[0]
+            book = conn.execute('select id, clipnum from Books '
+                                'order by clipnum desc limit 1;').fetchone()
+        urls = {
+            'index': '/',
+            'index_last': '/page/{}'.format(
+                math.ceil(book_count / app.config['PER_PAGE_BOOK'])),
+            'book': '/book/{}'.format(book['id']),
+            'book_last': '/book/{}?clippage={}'.format(
+                book['id'],
+                math.ceil(book['clipnum'] / app.config['PER_PAGE_CLIP'])),
+        }
+
+        client = app.test_client()
+        size = cache.size
+        results = {'books': book_count, 'requests': requests}
+        for name, url in urls.items():
+            cache.size = 0
+            uncached = _timeit(client, url, requests)
+            cache.size = size
+            client.get(url)
+            cached = _timeit(client, url, requests)
+            results[name] = {'url': url, 'uncached_ms': uncached,
+                             'cached_ms': cached,
+                             'speedup': round(uncached / cached, 2)}
+        cache.bump()
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Benchmark the index and book pages.')
+    argp.add_argument('-n', '--clips', type=int, default=100000)
+    argp.add_argument('-f', '--file', help='已有的或要生成的文件，'
+                      '默认在临时目录中按记录数生成一次并重复使用')
+    argp.add_argument('-r', '--requests', type=int, default=200,
+                      help='每个页面请求的次数')
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    path = args.file or os.path.join(
+        tempfile.gettempdir(), 'clindle_bench_{}.txt'.format(args.clips))
+    if not os.path.exists(path):
+        generate(path, args.clips)
+    results = run(path, args.requests)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{books} books, {requests} requests per page'.format(**results))
+    for name, result in results.items():
+        if isinstance(result, dict):
+            print('{:<11} {uncached_ms:>8.3f} ms  cached {cached_ms:>7.3f} ms  '
+                  '{speedup:>6}x  {url}'.format(name, **result))
+
+
+if __name__ == '__main__':
+    main()
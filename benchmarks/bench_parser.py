@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+bench_parser
+------------
+比较 ClipsParser 与之前的逐行解析（每条记录都用会回溯的正则匹配标注信息行，
+每次调用都重新编译时间和位置的正则）的解析速度，并检查两者的输出完全相同。
+ClipsParser 单进程运行；指定 -w 时再测一次多进程解析。
+
+    python benchmarks/bench_parser.py              # 生成 1,000,000 条记录
+    python benchmarks/bench_parser.py -n 100000 -f /tmp/My_Clippings.txt
+    python benchmarks/bench_parser.py -w 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kindle_parser  # noqa: E402
+from kindle_parser import ClipsParser  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+
+class LegacyParser(object):
+    """之前的解析方式，只保留 iter_clips() 用到的部分。"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _format_time(self, timestr):
+        patn = re.compile(r'(\d*)年(\d*)月(\d*)日.*(.{1})午(\d*):(\d*):(\d*)')
+        tiktok = patn.match(timestr)
+        year = tiktok.group(1)
+        timelist = [year] + \
+            ['{:0>2}'.format(tiktok.group(i)) for i in (2, 3, 5, 6, 7)]
+        if tiktok.group(4) == '下':
+            if tiktok.group(5) != '12':
+                timelist[3] = str(int(timelist[3]) + 12)
+        return '-'.join(timelist[:3]) + ' ' + ':'.join(timelist[-3:])
+
+    def _format_pos(self, pos):
+        patn = re.compile(r'(?:.*#(\d+)-?(\d+)?)|(?:第(\d+)-?(\d+)?)')
+        posptn = patn.match(pos.replace(' ', ''))
+        if posptn.group(1):
+            s_pos, e_pos = posptn.group(1), posptn.group(2)
+        else:
+            s_pos, e_pos = posptn.group(3), posptn.group(4)
+        return (int(s_pos), int(e_pos)) if e_pos else (int(s_pos), int(s_pos))
+
+    def _iter_records(self):
+        with open(self.filename, 'rb') as f:
+            offset, prefix = 0, hashlib.md5()
+            record = []
+            for line in f:
+                offset += len(line)
+                prefix.update(line)
+                line = line.decode('utf-8').rstrip('\r\n')
+                if line == '==========':
+                    self.checkpoint = (offset, prefix.hexdigest())
+                    if record:
+                        yield record
+                    record = []
+                elif line:
+                    record.append(line)
+            if record:
+                yield record
+
+    def _parseclip(self, clip):
+        bookname = clip[0].lstrip('\ufeff').strip()
+        index_md5 = hashlib.md5()
+        index_md5.update(str(clip).encode('utf-8'))
+        index = index_md5.hexdigest()
+        attrs = re.match(r'.*您在(.{1}\s[0-9-]+\s.{1})?.*?(#[0-9-]+)?.?'
+                         r'的(.*)?\s\|\s添加于\s(.*)$', clip[1])
+        if attrs.group(1):
+            if attrs.group(2):
+                pos = attrs.group(1) + '(' + attrs.group(2) + ')'
+            else:
+                pos = attrs.group(1)
+        else:
+            pos = attrs.group(2)
+        try:
+            content = clip[2]
+        except IndexError:
+            content = None
+        start_pos, end_pos = self._format_pos(pos)
+        return bookname, index, {
+            'type': attrs.group(3), 'pos': pos,
+            'start_pos': start_pos, 'end_pos': end_pos,
+            'time': self._format_time(attrs.group(4)), 'content': content}
+
+    def iter_clips(self):
+        for record in self._iter_records():
+            yield self._parseclip(record)
+
+
+def _timeit(make_parser, repeat):
+    """返回 (记录数, 最快一次的秒数)。每次都用新的解析器，避免从 checkpoint 继续。"""
+    best = None
+    for _ in range(repeat):
+        parser = make_parser()
+        start = time.perf_counter()
+        clips = deque(enumerate(parser.iter_clips()), maxlen=1)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (clips[0][0] + 1 if clips else 0), best
+
+
+def _digest(parser):
+    """按产出顺序计算所有结果的md5，用于比较两种解析的输出。
+    Clip 和字典都按之前的字典格式计算。"""
+    digest = hashlib.md5()
+    for bookname, index, clip in parser.iter_clips():
+        clip = {key: clip[key] for key in clip.keys()}
+        digest.update(repr((bookname, index, clip)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def run(path, repeat=1, workers=None, legacy=True):
+    """解析 path，返回各种解析方式的速度和输出是否一致。
+    workers 大于1时，再测一次使用 workers 个进程的解析（不受文件大小限制）。
+    legacy 为 False 时不测之前的解析方式，也不检查输出。
+    """
+    parsers = [('parser', lambda: ClipsParser(path, workers=1))]
+    if legacy:
+        parsers.insert(0, ('legacy', lambda: LegacyParser(path)))
+    if workers and workers > 1:
+        parsers.append(('parallel', lambda: ClipsParser(path, workers=workers)))
+        kindle_parser.PARALLEL_PARSE_THRESHOLD = 0
+    results = {}
+    for name, make_parser in parsers:
+        clips, seconds = _timeit(make_parser, repeat)
+        results[name] = {'clips': clips, 'seconds': round(seconds, 3),
+                         'clips_per_sec': round(clips / seconds)}
+    if not legacy:
+        return results
+    for name, _ in parsers[1:]:
+        results[name]['speedup'] = round(
+            results[name]['clips_per_sec'] /
+            results['legacy']['clips_per_sec'], 2)
+    expected = _digest(LegacyParser(path))
+    results['identical'] = all(_digest(make_parser()) == expected
+                               for _, make_parser in parsers[1:])
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Benchmark ClipsParser against the legacy parser.')
+    argp.add_argument('-n', '--clips', type=int, default=1000000)
+    argp.add_argument('-f', '--file', help='已有的或要生成的文件，'
+                      '默认在临时目录中按记录数生成一次并重复使用')
+    argp.add_argument('-r', '--repeat', type=int, default=1)
+    argp.add_argument('-w', '--workers', type=int,
+                      help='同时测试使用多少个进程的解析')
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    path = args.file or os.path.join(
+        tempfile.gettempdir(), 'clindle_bench_{}.txt'.format(args.clips))
+    if not os.path.exists(path):
+        generate(path, args.clips)
+    results = run(path, args.repeat, args.workers)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name in ('legacy', 'parser', 'parallel'):
+            if name not in results:
+                continue
+            result = dict({'speedup': 1}, **results[name])
+            print('{:<8} {clips:>9} clips  {seconds:>8.3f} s  '
+                  '{clips_per_sec:>9} clips/s  {speedup:>5}x'.format(
+                      name, **result))
+        print('identical output: {}'.format(results['identical']))
+    return 0 if results['identical'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+bench_save2db
+-------------
+比较 save2db 的批量写入与之前逐条 execute 的写入速度（每秒写入的行数）。
+两者都写入新建的临时数据库，输入是预先解析好的合成数据。
+legacy_save2db 只保留了之前逐条 execute、逐本书查询id的写入方式，
+表结构（索引、计数和全文检索的触发器）和关联笔记的区间索引 ClipIntervals
+都是现在的，并不是最初的 save2db；加速比只反映批量写入本身，
+不是相对最初的代码测得的。
+
+    python benchmarks/bench_save2db.py              # 500,000 条记录
+    python benchmarks/bench_save2db.py -n 50000 --relaxed
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+from db import connect  # noqa: E402
+from kindle_parser import ClipsParser  # noqa: E402
+from synthetic import generate  # noqa: E402
+from utils import ClipIntervals, init_schema, pinyin_key, save2db  # noqa: E402
+
+
+def legacy_save2db(records, database):
+    """之前的写入方式：每条记录一次 execute，每本书查询一次id，整体一个隐式事务。"""
+    conn = connect(database)
+    cur = conn.cursor()
+    init_schema(conn)
+
+    def _sep_t_a(title):
+        if not title.endswith(')'):
+            return title, None
+        ptn = r'.*(\([^()]*\))$'
+        for i in range(5):
+            author_match = re.match(ptn, title)
+            if author_match:
+                author = author_match.group(1)[1:-1]
+                return title[:-len(author)-2], author
+            ptn = ptn[:3] + r'\(.*?' + ptn[3:-2] + r'.*?\)' + ptn[-2:]
+        return title, None
+
+    def _bookid(bookname):
+        title, author = _sep_t_a(bookname)
+        cur.execute('select id from Books where title = ?;', (title,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        cur.execute(
+            'insert into Books(title, author, titlekey, cover) values('
+            '?, ?, ?, (select filename from Covers where title = ?));',
+            (title, author, pinyin_key(title), title))
+        intervals[cur.lastrowid] = ClipIntervals()
+        return cur.lastrowid
+
+    def _intervals(bookid):
+        if bookid not in intervals:
+            index = intervals[bookid] = ClipIntervals()
+            cur.execute('select startpos, endpos, id from Clips '
+                        'where bookid = ? order by startpos;', (bookid,))
+            for start, end, clipid in cur:
+                index.add(start, end, clipid)
+        return intervals[bookid]
+
+    bookids, intervals, notes = {}, {}, []
+    for bookname, index, clip in records:
+        bookid = bookids.get(bookname)
+        if bookid is None:
+            bookid = bookids[bookname] = _bookid(bookname)
+        if clip['type'] == '标注':
+            cur.execute(
+                'insert or ignore into Clips(md5, pos, startpos, endpos, '
+                'time, content, bookid) values(?, ?, ?, ?, ?, ?, ?);',
+                (index, clip['pos'], clip['start_pos'], clip['end_pos'],
+                 clip['time'], clip['content'], bookid))
+            if cur.rowcount == 1 and bookid in intervals:
+                intervals[bookid].add(clip['start_pos'], clip['end_pos'],
+                                      cur.lastrowid)
+        elif clip['type'] == '书签':
+            cur.execute(
+                'insert or ignore into Marks(md5, pos, startpos, endpos, '
+                'time, bookid) values(?, ?, ?, ?, ?, ?);',
+                (index, clip['pos'], clip['start_pos'], clip['end_pos'],
+                 clip['time'], bookid))
+        else:
+            notes.append((bookid, index, clip))
+    for bookid, index, clip in notes:
+        cur.execute('select 1 from Notes where md5 = ?;', (index,))
+        if cur.fetchone():
+            continue
+        for clipid in _intervals(bookid).covering(clip['start_pos']):
+            cur.execute(
+                'insert or ignore into Notes(md5, pos, time, content, '
+                'bookid, clipid) values(?, ?, ?, ?, ?, ?);',
+                (index, clip['pos'], clip['time'], clip['content'], bookid,
+                 clipid))
+    conn.commit()
+    conn.close()
+
+
+def _rows(database):
+    conn = connect(database)
+    rows = sum(conn.execute('select count(*) from {};'.format(table))
+               .fetchone()[0] for table in ('Books', 'Clips', 'Notes', 'Marks'))
+    conn.close()
+    return rows
+
+
+def _timeit(name, load, records, folder):
+    database = os.path.join(folder, name + '.db')
+    start = time.perf_counter()
+    load(records, database)
+    seconds = time.perf_counter() - start
+    rows = _rows(database)
+    return {'rows': rows, 'seconds': round(seconds, 3),
+            'rows_per_sec': round(rows / seconds)}
+
+
+def run(path, relaxed=False, batch_size=None, legacy=True):
+    """写入 path 中的记录，返回各种写入方式的速度。
+    legacy 为 False 时不测之前的写入方式。"""
+    records = list(ClipsParser(path).iter_clips())
+
+    def bulk(records, database):
+        error = save2db(records, database=database)
+        assert error is None, error
+
+    loaders = [('bulk', bulk)]
+    if legacy:
+        loaders.insert(0, ('legacy', legacy_save2db))
+    if relaxed:
+        def bulk_relaxed(records, database):
+            pragmas = utils.BULK_PRAGMAS
+            utils.BULK_PRAGMAS = {'synchronous': 'off'}
+            try:
+                bulk(records, database)
+            finally:
+                utils.BULK_PRAGMAS = pragmas
+        loaders.append(('relaxed', bulk_relaxed))
+
+    folder = tempfile.mkdtemp(prefix='clindle_bench_')
+    # run.py 在同一进程中依次运行各项测试，结束后恢复
+    batch = utils.BULK_BATCH_SIZE
+    if batch_size:
+        utils.BULK_BATCH_SIZE = batch_size
+    try:
+        results = {name: _timeit(name, load, records, folder)
+                   for name, load in loaders}
+    finally:
+        utils.BULK_BATCH_SIZE = batch
+        shutil.rmtree(folder)
+    results['clips'] = len(records)
+    if legacy:
+        for name, _ in loaders[1:]:
+            results[name]['speedup'] = round(
+                results[name]['rows_per_sec'] /
+                results['legacy']['rows_per_sec'], 2)
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Benchmark bulk save2db against per-row inserts.')
+    argp.add_argument('-n', '--clips', type=int, default=500000)
+    argp.add_argument('-f', '--file', help='已有的或要生成的文件，'
+                      '默认在临时目录中按记录数生成一次并重复使用')
+    argp.add_argument('-b', '--batch-size', type=int,
+                      help='覆盖 BULK_BATCH_SIZE')
+    argp.add_argument('--relaxed', action='store_true',
+                      help="同时测试 BULK_PRAGMAS = {'synchronous': 'off'}")
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    path = args.file or os.path.join(
+        tempfile.gettempdir(), 'clindle_bench_{}.txt'.format(args.clips))
+    if not os.path.exists(path):
+        generate(path, args.clips)
+    results = run(path, args.relaxed, args.batch_size)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{} clips'.format(results['clips']))
+    for name in ('legacy', 'bulk', 'relaxed'):
+        if name not in results:
+            continue
+        result = dict({'speedup': 1}, **results[name])
+        print('{:<8} {rows:>9} rows  {seconds:>8.3f} s  '
+              '{rows_per_sec:>9} rows/s  {speedup:>5}x'.format(name, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+bench_snapshot
+--------------
+比较二进制快照与之前的 JSON Lines 备份：文件大小、写入速度，
+以及从快照读取与重新解析文本文件的速度；检查读回的记录与解析结果完全相同，
+并且同一个文件入库后再追加时，只写入数据库中没有的记录
+（入库时被合并掉的重复标注）。
+指定 --db 时再比较从快照重建数据库与解析后入库的总时间。
+
+    python benchmarks/bench_snapshot.py              # 500,000 条记录
+    python benchmarks/bench_snapshot.py -n 50000 --db
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import get_pool  # noqa: E402
+from kindle_parser import ClipsParser  # noqa: E402
+from snapshot import Snapshot, restore  # noqa: E402
+from synthetic import generate  # noqa: E402
+from utils import save2db  # noqa: E402
+
+
+def _timeit(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round(time.perf_counter() - start, 3)
+
+
+def run(path, db=False):
+    """返回各项的秒数、文件大小和检查结果。"""
+    folder = tempfile.mkdtemp(prefix='clindle_bench_')
+    try:
+        results = {'text_bytes': os.path.getsize(path)}
+        clips, results['parse_seconds'] = _timeit(
+            lambda: list(ClipsParser(path, workers=1).iter_clips()))
+        results['clips'] = len(clips)
+
+        jsonfile = os.path.join(folder, 'backup.jsonl')
+
+        def _json():
+            with open(jsonfile, 'w') as f:
+                f.writelines(json.dumps([bookname, index, clip.as_dict()]) +
+                             '\n' for bookname, index, clip in clips)
+        _, results['json_write_seconds'] = _timeit(_json)
+        results['json_bytes'] = os.path.getsize(jsonfile)
+
+        snapshot = Snapshot(os.path.join(folder, 'clips.snap'))
+        _, results['snapshot_write_seconds'] = _timeit(
+            lambda: deque(snapshot.append(clips), maxlen=0))
+        results['snapshot_bytes'] = os.path.getsize(snapshot.path)
+        restored, results['snapshot_read_seconds'] = _timeit(
+            lambda: list(snapshot.iter_clips()))
+        results['identical'] = restored == clips
+        results['read_speedup'] = round(
+            results['parse_seconds'] / results['snapshot_read_seconds'], 2)
+        del restored
+
+        # 同一个文件再上传一次：已经存入数据库的记录不再追加，
+        # 入库时被合并掉的重复标注会再追加一次
+        database = os.path.join(folder, 'append.db')
+        error = save2db(iter(clips), incremental=False, database=database)
+        assert error is None, error
+        reappend = Snapshot(snapshot.path, database=database)
+        _, results['snapshot_reappend_seconds'] = _timeit(
+            lambda: deque(reappend.append(clips), maxlen=0))
+        results['reappend_added'] = reappend.added
+        with get_pool(database).connection() as conn:
+            saved = {row[0] for table in ('Clips', 'Marks', 'Notes')
+                     for row in conn.execute(
+                         'select md5 from {};'.format(table))}
+        results['reappend_expected'] = sum(
+            index not in saved for _, index, _ in clips)
+
+        if db:
+            def _reparse():
+                return save2db(ClipsParser(path, workers=1).iter_clips(),
+                               incremental=False,
+                               database=os.path.join(folder, 'parse.db'))
+            error, results['db_from_text_seconds'] = _timeit(_reparse)
+            assert error is None, error
+            error, results['db_from_snapshot_seconds'] = _timeit(
+                lambda: restore(snapshot.path,
+                                os.path.join(folder, 'snapshot.db')))
+            assert error is None, error
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Benchmark the binary snapshot against the JSON backup.')
+    argp.add_argument('-n', '--clips', type=int, default=500000)
+    argp.add_argument('-f', '--file', help='已有的或要生成的文件，'
+                      '默认在临时目录中按记录数生成一次并重复使用')
+    argp.add_argument('--db', action='store_true',
+                      help='同时比较重建数据库的时间')
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    path = args.file or os.path.join(
+        tempfile.gettempdir(), 'clindle_bench_{}.txt'.format(args.clips))
+    if not os.path.exists(path):
+        generate(path, args.clips)
+    results = run(path, args.db)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print('{:<28} {}'.format(key, value))
+    return 0 if results['identical'] and \
+        results['reappend_added'] == results['reappend_expected'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+bench_startup
+-------------
+测量启动开销：每次都在新的 Python 进程中进行。
+- import: `python -X importtime -c "import clindle"` 的总耗时，以及累计耗时最多的模块；
+- first_request: 导入、create_app()，以及之后第一次、第二次请求书籍列表和书籍页面
+  的耗时（第一次请求时还要连接数据库、编译模板等）；
+- eager: 在导入 clindle 之前先导入 pypinyin、requests、bs4、flask_wtf，
+  相当于之前在导入时就加载这些模块的情况，用于对比。
+数据库由合成数据写入临时目录，不会修改 data/ 中的数据库。
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py -r 10 --top 20
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindle_parser import ClipsParser  # noqa: E402
+from synthetic import generate  # noqa: E402
+from utils import save2db  # noqa: E402
+
+# 之前在导入 clindle 时就会加载的较大的模块
+EAGER = ('pypinyin', 'requests', 'bs4', 'flask_wtf')
+
+# 在子进程中执行，结果以JSON输出到标准输出
+_CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+for name in {eager!r}:
+    __import__(name)
+import clindle
+imported = time.perf_counter()
+app = clindle.create_app({settings!r})
+created = time.perf_counter()
+client = app.test_client()
+result = {{'import_ms': (imported - start) * 1000,
+          'create_app_ms': (created - imported) * 1000}}
+for name, url in {urls!r}:
+    for n in ('first', 'second'):
+        t = time.perf_counter()
+        status = client.get(url).status_code
+        assert status == 200, (url, status)
+        result['{{}}_{{}}_ms'.format(name, n)] = (time.perf_counter() - t) * 1000
+result['loaded'] = sorted(name for name in {watch!r} if name in sys.modules)
+print(json.dumps(result))
+'''
+
+
+def _python(args, **kwargs):
+    return subprocess.run([sys.executable] + args, cwd=ROOT, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, **kwargs)
+
+
+def importtime(top=10):
+    """`python -X importtime` 的总耗时（毫秒）和累计耗时最多的 top 个模块。"""
+    stderr = _python(['-X', 'importtime', '-c', 'import clindle']).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # 子模块先于导入它的模块输出，按缩进区分层级；
+        # 只保留 clindle 导入的模块，不包括 site 等启动时已经导入的
+        if not name[1:].startswith(' ') and name.strip() != 'clindle':
+            modules = []
+            continue
+        modules.append((name.strip(), int(cumulative) / 1000))
+    # 最后一行是 clindle 本身，累计耗时即导入的总耗时
+    total = modules[-1][1]
+    heaviest = sorted(modules[:-1], key=lambda m: m[1], reverse=True)
+    return {'total_ms': round(total, 1),
+            'top': [[name, round(ms, 1)] for name, ms in heaviest[:top]]}
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def first_request(urls, settings, eager=(), runs=5):
+    """在 runs 个新进程中分别测量，返回各项耗时的中位数（毫秒）。"""
+    code = _CHILD.format(eager=tuple(eager), settings=settings, urls=urls,
+                         watch=EAGER + ('kindle_parser', 'cover'))
+    samples = [json.loads(_python(['-c', code]).stdout.splitlines()[-1])
+               for _ in range(runs)]
+    result = {key: round(_median([s[key] for s in samples]), 2)
+              for key in samples[0] if key.endswith('_ms')}
+    result['loaded'] = samples[-1]['loaded']
+    return result
+
+
+def run(path, runs=5, top=10):
+    folder = tempfile.mkdtemp(prefix='clindle_bench_')
+    try:
+        settings = {name: os.path.join(folder, name)
+                    for name in ('DATABASE', 'COVERPIC_FOLDER',
+                                 'SNAPSHOT_FILE')}
+        error = save2db(ClipsParser(path).iter_clips(),
+                        database=settings['DATABASE'])
+        assert error is None, error
+        urls = (('index', '/'), ('book', '/book/1'))
+        results = {'runs': runs, 'import': importtime(top)}
+        results['lazy'] = first_request(urls, settings, runs=runs)
+        results['eager'] = first_request(urls, settings, EAGER, runs)
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Benchmark import time and first-request latency.')
+    argp.add_argument('-n', '--clips', type=int, default=10000)
+    argp.add_argument('-f', '--file', help='已有的或要生成的文件，'
+                      '默认在临时目录中按记录数生成一次并重复使用')
+    argp.add_argument('-r', '--runs', type=int, default=5,
+                      help='进程数，结果取中位数')
+    argp.add_argument('--top', type=int, default=10,
+                      help='列出导入耗时最多的模块数')
+    argp.add_argument('--json', action='store_true', help='以JSON格式输出')
+    args = argp.parse_args()
+
+    path = args.file or os.path.join(
+        tempfile.gettempdir(), 'clindle_bench_{}.txt'.format(args.clips))
+    if not os.path.exists(path):
+        generate(path, args.clips)
+    results = run(path, args.runs, args.top)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('import clindle: {total_ms:.1f} ms (-X importtime)'.format(
+        **results['import']))
+    for name, ms in results['import']['top']:
+        print('  {:<40} {:>8.1f} ms'.format(name, ms))
+    print('median of {} processes:'.format(results['runs']))
+    lazy, eager = results['lazy'], results['eager']
+    print('{:<22} {:>10} {:>10}'.format('', 'lazy', 'eager'))
+    for key in lazy:
+        if key.endswith('_ms'):
+            print('{:<22} {:>10.2f} {:>10.2f}'.format(key, lazy[key],
+                                                      eager[key]))
+    print('loaded after requests: {}'.format(', '.join(lazy['loaded'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+run
+---
+运行全部性能测试，并把结果写入JSON报告，与上一次的报告比较以发现性能退化。
+parse/save2db/snapshot/pages/memory 在每种记录数下各运行一次（合成数据在临时目录中
+按记录数生成一次并重复使用），covers 和 startup 与记录数无关，只运行一次。
+
+    python benchmarks/run.py                        # 1k、10k、100k 条记录
+    python benchmarks/run.py -s 1000 1000000 --legacy
+    python benchmarks/run.py -b parse save2db --compare report.json
+
+报告默认写入 benchmarks/reports/，并与该目录中最近的一份报告比较：
+*_per_sec 变小或 *_ms/seconds 变大超过 --threshold 时列出，并以状态1退出。
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import traceback
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import bench_covers  # noqa: E402
+import bench_memory  # noqa: E402
+import bench_pages  # noqa: E402
+import bench_parser  # noqa: E402
+import bench_save2db  # noqa: E402
+import bench_snapshot  # noqa: E402
+import bench_startup  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+REPORT_FOLDER = os.path.join(HERE, 'reports')
+BENCHES = ('parse', 'save2db', 'snapshot', 'pages', 'memory', 'covers',
+           'startup')
+
+
+def _environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit, 'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def _clippings(clips):
+    path = os.path.join(tempfile.gettempdir(),
+                        'clindle_bench_{}.txt'.format(clips))
+    if not os.path.exists(path):
+        generate(path, clips)
+    return path
+
+
+def run(sizes, benches=BENCHES, legacy=False, requests=200, books=200,
+        latency=20):
+    report = dict(_environment(), sizes=sizes, results={})
+    suites = {
+        'parse': lambda path: bench_parser.run(path, legacy=legacy),
+        'save2db': lambda path: bench_save2db.run(path, legacy=legacy),
+        'snapshot': bench_snapshot.run,
+        'pages': lambda path: bench_pages.run(path, requests),
+        'memory': lambda path: bench_memory.run(path, legacy=legacy),
+    }
+    for name in benches:
+        results = report['results'][name] = {}
+        if name == 'covers':
+            jobs = [('all', lambda: bench_covers.run(books, latency))]
+        elif name == 'startup':
+            jobs = [('all', lambda: bench_startup.run(_clippings(10000)))]
+        else:
+            jobs = [(str(clips), lambda clips=clips: suites[name](
+                _clippings(clips))) for clips in sizes]
+        for key, job in jobs:
+            print('{} {}...'.format(name, key), file=sys.stderr, flush=True)
+            try:
+                results[key] = job()
+            except Exception as e:
+                # 某一项失败（例如缺少依赖）时继续运行其他测试
+                traceback.print_exc()
+                results[key] = {'error': '{}: {}'.format(type(e).__name__, e)}
+    return report
+
+
+def _metrics(results, prefix=''):
+    """展开为 {'parse.1000.parser.clips_per_sec': value} 形式。"""
+    metrics = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            metrics.update(_metrics(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def compare(report, previous, threshold=0.1):
+    """返回变慢超过 threshold 的 [(指标, 之前, 现在)]。"""
+    old, new = _metrics(previous['results']), _metrics(report['results'])
+    regressions = []
+    for name, value in new.items():
+        before = old.get(name)
+        if not before or not value:
+            continue
+        if name.endswith('_per_sec'):
+            worse = before / value - 1
+        elif name.endswith(('_ms', 'seconds')):
+            worse = value / before - 1
+        else:
+            continue
+        if worse > threshold:
+            regressions.append((name, before, value))
+    return regressions
+
+
+def _latest_report():
+    if not os.path.isdir(REPORT_FOLDER):
+        return None
+    names = sorted(name for name in os.listdir(REPORT_FOLDER)
+                   if name.endswith('.json'))
+    return os.path.join(REPORT_FOLDER, names[-1]) if names else None
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Run all benchmarks and write a JSON report.')
+    argp.add_argument('-s', '--sizes', type=int, nargs='+',
+                      default=[1000, 10000, 100000], help='记录数')
+    argp.add_argument('-b', '--benches', nargs='+', choices=BENCHES,
+                      default=list(BENCHES))
+    argp.add_argument('--legacy', action='store_true',
+                      help='同时测试之前的解析和写入方式（较慢）')
+    argp.add_argument('-r', '--requests', type=int, default=200,
+                      help='pages: 每个页面请求的次数')
+    argp.add_argument('--books', type=int, default=200,
+                      help='covers: 书籍数')
+    argp.add_argument('--latency', type=int, default=20,
+                      help='covers: 模拟的请求延迟（毫秒）')
+    argp.add_argument('-o', '--output', help='报告文件，默认写入 '
+                      'benchmarks/reports/<时间>.json')
+    argp.add_argument('--compare', help='与这份报告比较，默认为 '
+                      'benchmarks/reports/ 中最近的一份')
+    argp.add_argument('--threshold', type=float, default=0.1,
+                      help='超过多少比例算作性能退化')
+    args = argp.parse_args()
+
+    previous = args.compare or _latest_report()
+    report = run(args.sizes, args.benches, args.legacy, args.requests,
+                 args.books, args.latency)
+    output = args.output or os.path.join(
+        REPORT_FOLDER, datetime.now().strftime('%Y%m%d_%H%M%S.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print('report: {}'.format(output))
+
+    if not previous:
+        return 0
+    with open(previous) as f:
+        regressions = compare(report, json.load(f), args.threshold)
+    print('compared with {}: {} regression(s)'.format(
+        previous, len(regressions)))
+    for name, before, value in regressions:
+        print('  {:<50} {:>12} -> {}'.format(name, before, value))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
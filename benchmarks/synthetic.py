@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+synthetic
+---------
+生成用于性能测试的 "My Clippings.txt"。
+书名、位置、时间和内容都是随机的，但格式与 Kindle 生成的一致：
+包括 ClipsParser._format_pos 能处理的各种位置写法，以及标注、笔记和书签。
+
+    python benchmarks/synthetic.py 100000 /tmp/My_Clippings.txt
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+
+SPLIT_LINE = '=========='
+BOM = '\ufeff'
+WEEKDAYS = '一二三四五六日'
+# 用于拼接内容的常用汉字和标点
+CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可'
+         '主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电'
+         '力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由'
+         '其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利'
+         '，。；：？！、')
+SERIES = ['读客全球顶级畅销小说文库 {}', '译林幻系列', '图灵原创', '大师批评译丛',
+          '理想国•人文精选:{:02}', '果麦经典']
+AUTHORS = ['王坚', '周其仁', '阿城', '加·泽文', '(美)查普曼', '约瑟夫·布罗茨基',
+           '埃里克·西格尔', 'Douglas R. Hofstadter']
+
+
+def _text(rnd, low, high):
+    return ''.join(rnd.choice(CHARS) for _ in range(rnd.randint(low, high)))
+
+
+def _title(rnd, num):
+    """书名，包含嵌套括号和丛书名，作者放在最后的括号中。"""
+    title = _text(rnd, 2, 8) + str(num)
+    kind = rnd.random()
+    if kind < 0.3:
+        title += '（{}（{}））'.format(_text(rnd, 4, 12), _text(rnd, 2, 4))
+    elif kind < 0.5:
+        title += '({})'.format(_text(rnd, 4, 12))
+    if rnd.random() < 0.4:
+        title += ' ({})'.format(rnd.choice(SERIES).format(rnd.randint(1, 300)))
+    if rnd.random() < 0.9:
+        title += ' ({})'.format(rnd.choice(AUTHORS))
+    return title
+
+
+def _time(now):
+    """Kindle 的12小时制时间，'2017年1月1日星期日 下午3:23:07'。"""
+    return '{}年{}月{}日星期{} {}午{}:{:02}:{:02}'.format(
+        now.year, now.month, now.day, WEEKDAYS[now.weekday()],
+        '上' if now.hour < 12 else '下', now.hour % 12 or 12,
+        now.minute, now.second)
+
+
+def _header(rnd, clip_type, start, end, page, now):
+    """各种位置写法：
+    '位置 #1-2' | '位置 #1' | '第 1 页（位置 #1-2）' | '第 1 页（位置 #1）'
+    | '第 1-2 页' | '第 1 页'
+    """
+    loc = start if start == end else '{}-{}'.format(start, end)
+    kind = rnd.random()
+    if clip_type == '标注':
+        if kind < 0.75:
+            pos = '位置 #{}'.format(loc)
+        elif kind < 0.85:
+            pos = '第 {} 页（位置 #{}）'.format(page, loc)
+        elif kind < 0.95:
+            pos = '第 {} 页'.format(page)
+        else:
+            pos = '第 {}-{} 页'.format(page, page + 1)
+    else:
+        if kind < 0.85:
+            pos = '位置 #{} '.format(start)
+        else:
+            pos = '第 {} 页（位置 #{}）'.format(page, start)
+    return '- 您在{}的{} | 添加于 {}'.format(pos, clip_type, _time(now))
+
+
+def iter_records(clips, books=None, seed=0):
+    """产出 clips 条记录的文本（含结尾的分隔行）。
+    标注约占 80%，每 10 条标注附带一条笔记，其余为书签。
+    和真实的文件一样，记录按时间顺序追加，两条记录之间相隔几秒到几小时。
+    """
+    rnd = random.Random(seed)
+    now = datetime(2013, 1, 1)
+    books = books or max(1, clips // 200)
+    titles = [_title(rnd, num) for num in range(books)]
+    num = 0
+    while num < clips:
+        title = rnd.choice(titles)
+        now += timedelta(seconds=int(rnd.expovariate(1 / 600)) + 5)
+        prefix = BOM if rnd.random() < 0.05 else ''
+        start = rnd.randint(1, 20000)
+        end = start + rnd.randint(0, 8)
+        page = start // 15 + 1
+        if rnd.random() < 0.85:
+            content = _text(rnd, 10, 80)
+            yield '{}{}\n{}\n\n{}\n{}\n'.format(
+                prefix, title, _header(rnd, '标注', start, end, page, now),
+                content, SPLIT_LINE)
+            num += 1
+            if num < clips and rnd.random() < 0.1:
+                yield '{}\n{}\n\n{}\n{}\n'.format(
+                    title, _header(rnd, '笔记', end, end, page, now),
+                    _text(rnd, 4, 40), SPLIT_LINE)
+                num += 1
+        else:
+            yield '{}{}\n{}\n\n\n{}\n'.format(
+                prefix, title, _header(rnd, '书签', start, start, page, now),
+                SPLIT_LINE)
+            num += 1
+
+
+def generate(path, clips, books=None, seed=0):
+    """生成包含 clips 条记录的文件，返回 path。"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in iter_records(clips, books, seed):
+            f.write(record)
+    return path
+
+
+if __name__ == '__main__':
+    generate(sys.argv[2], int(sys.argv[1]))
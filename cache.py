@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+cache
+-----
+页面响应缓存。书籍列表和书籍页面的内容只在上传入库（或获取封面）后才会变化，
+所以把渲染好的页面按 (视图, 参数, 数据版本) 缓存起来，重复访问时不再执行页面的
+查询、也不再渲染模板。命中缓存并不是完全不访问数据库，见下面的 version。
+- 数据版本 generation 在每次入库后由 bump() 加一，旧版本的缓存自然失效；
+- 进程内 LRU，可选地同时写入磁盘目录，内存中被淘汰的页面还可以从磁盘读取；
+- 响应带有 ETag/Last-Modified，条件请求命中时返回 304；
+- 有待显示的 flash 消息时不使用缓存；
+- 给出 scope()（例如当前用户）时按 scope 分别缓存，bump(scope) 只使该
+  scope 的缓存失效，一个用户入库不影响其他用户的缓存。
+没有给出 version 时 generation 只保存在进程内，其他进程（其他 worker、
+flask restoredb 等）修改数据库后，缓存最多在 ttl 秒后才过期；
+给出 version(scope) 时每次请求都由它读取 (数据版本, 修改时间)，例如从数据库中
+读取，数据版本随数据在同一事务中更新，所有进程立即看到。clindle 使用这种方式：
+每次命中都要查询一次 Generations 表（主键查询），书籍列表还要由 jobs.busy()
+查询一次 Jobs 表。不要把它改回进程内的计数器，那样在多个进程之间是错误的。
+init_app(app) 为每个 app 建立单独的缓存，保存在 app.extensions['clindle_cache']，
+模块级的 ResponseCache 装饰的视图在请求中使用当前 app 的缓存。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, has_app_context, make_response, request, \
+    session
+
+from metrics import RESPONSE_CACHE
+
+
+class ResponseCache(object):
+    def __init__(self, size=256, ttl=600, folder=None, scope=None,
+                 version=None):
+        self.size = size
+        self.ttl = ttl
+        self.folder = folder
+        self.scope = scope
+        self.version = version
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 进程启动时间作为版本号的前缀，避免读到上次运行时写入磁盘的缓存
+        self._epoch = '{:x}'.format(time.time_ns())
+        self._generation = 0
+        self.modified = time.time()
+        # scope -> (版本号, 修改时间)
+        self._scopes = {}
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def init_app(self, app):
+        """为 app 建立使用其配置 RESPONSE_CACHE_SIZE/TTL/FOLDER 的缓存并返回，
+        scope 和 version 与本对象相同。本对象不变。"""
+        cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'],
+                              app.config['RESPONSE_CACHE_TTL'],
+                              app.config['RESPONSE_CACHE_FOLDER'],
+                              self.scope, self.version)
+        app.extensions['clindle_cache'] = cache
+        return cache
+
+    def _cache(self):
+        """当前 app 的缓存；不在应用上下文中或 app 没有缓存时为本对象。"""
+        if has_app_context():
+            return current_app.extensions.get('clindle_cache', self)
+        return self
+
+    @property
+    def generation(self):
+        return '{}.{}'.format(self._epoch, self._generation)
+
+    def _version(self, scope):
+        """scope 的 (版本号, 修改时间)。"""
+        if self.version is not None:
+            # 保存在数据库中的版本在重启之后仍然有效，不需要 _epoch
+            generation, modified = self.version(scope)
+            return '{}.{}'.format(generation, modified), modified
+        generation, modified = self._scopes.get(scope, (0, 0))
+        return ('{}.{}'.format(self.generation, generation),
+                max(modified, self.modified))
+
+    def bump(self, scope=None):
+        """数据库内容发生变化后调用，使所有（或 scope 的）缓存失效。
+        给出 version 时只用于清理本进程内存和磁盘中的旧页面。"""
+        if self._cache() is not self:
+            return self._cache().bump(scope)
+        with self._lock:
+            if scope is None:
+                self._generation += 1
+                self.modified = time.time()
+                self._entries.clear()
+                self._scopes.clear()
+            else:
+                # 内存中旧版本的页面不会再被读到，由 LRU 淘汰
+                generation = self._scopes.get(scope, (0, 0))[0]
+                self._scopes[scope] = (generation + 1, time.time())
+        if self.folder:
+            prefix = '' if scope is None else self._prefix(scope)
+            for name in os.listdir(self.folder):
+                if name.endswith('.cache') and name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.folder, name))
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def _prefix(scope):
+        return hashlib.sha1(
+            json.dumps(scope).encode('utf-8')).hexdigest()[:12] + '-'
+
+    def _path(self, key):
+        # 文件名以 scope 开头，bump(scope) 时只删除该 scope 的文件
+        scope = json.loads(key)[0]
+        name = self._prefix(scope) + \
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache'
+        return os.path.join(self.folder, name)
+
+    def get(self, key):
+        """返回缓存的 (body, headers)，不存在或已过期时返回None。"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    return entry[1:]
+                del self._entries[key]
+        if not self.folder:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta['key'] != key or meta['expires'] <= now:
+            return None
+        self._store(key, (meta['expires'], body, meta['headers']))
+        return body, meta['headers']
+
+    def put(self, key, body, headers):
+        expires = time.time() + self.ttl
+        self._store(key, (expires, body, headers))
+        if self.folder:
+            meta = {'key': key, 'expires': expires, 'headers': headers}
+            path = self._path(key)
+            # 先写临时文件再改名，读取时不会看到写了一半的文件
+            with open(path + '.tmp', 'wb') as f:
+                f.write(json.dumps(meta).encode('utf-8') + b'\n' + body)
+            os.replace(path + '.tmp', path)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _key(self, scope, generation, per_session):
+        parts = [scope, generation, request.endpoint,
+                 sorted(request.view_args.items()),
+                 sorted(request.args.items(multi=True))]
+        if per_session:
+            # 页面中的 CSRF token 与会话相关
+            parts.append(session.get('csrf_token'))
+        return json.dumps(parts, ensure_ascii=False)
+
+    def cached(self, per_session=False, unless=None):
+        """视图函数的装饰器，缓存状态码为200的响应。
+        per_session 为 True 时每个会话分别缓存（页面中包含 CSRF token 等）；
+        unless() 返回 True 时（例如有正在运行的后台任务）不使用缓存。
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                return self._cache()._respond(view, args, kwargs,
+                                              per_session, unless)
+            return wrapper
+        return decorator
+
+    def _respond(self, view, args, kwargs, per_session, unless):
+        """cached() 装饰的视图的一次请求。"""
+        if not self.size or '_flashes' in session or \
+                (unless is not None and unless()):
+            RESPONSE_CACHE.inc(result='bypass')
+            return view(*args, **kwargs)
+        scope = self.scope() if self.scope is not None else None
+        # 渲染期间可能有入库完成，缓存到渲染开始时的版本下
+        generation, modified = self._version(scope)
+        cached = self.get(self._key(scope, generation, per_session))
+        RESPONSE_CACHE.inc(result='miss' if cached is None else 'hit')
+        if cached is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or '_flashes' in session:
+                return response
+            body = response.get_data()
+            headers = {
+                'Content-Type': response.content_type,
+                'ETag': hashlib.md5(body).hexdigest(),
+                'Last-Modified': modified,
+            }
+            # 渲染页面时可能新建了 CSRF token，按渲染之后的会话保存
+            self.put(self._key(scope, generation, per_session),
+                     body, headers)
+        else:
+            body, headers = cached
+        response = make_response(body)
+        response.content_type = headers['Content-Type']
+        response.set_etag(headers['ETag'])
+        response.last_modified = headers['Last-Modified']
+        # 浏览器每次都要验证，数据更新后可以立即看到
+        response.cache_control.no_cache = True
+        if per_session:
+            response.vary.add('Cookie')
+        return response.make_conditional(request)
@@ -8,120 +8,287 @@ License: BSD, see LICENSE for more details.
 """
 
 import math
-import random
-import re
-import requests
 import sqlite3
 import time
-from bs4 import BeautifulSoup
 from datetime import datetime
 
-from flask import (Flask, abort, flash, g, redirect, render_template, request,
-                   url_for)
-from flask_uploads import (TEXT, UploadNotAllowed, UploadSet,
-                           configure_uploads, patch_request_class)
-from flask_wtf import FlaskForm
-from flask_wtf.file import FileAllowed, FileField, FileRequired
-from pypinyin import lazy_pinyin
+import click
+from flask import (Blueprint, Flask, Response, abort, before_render_template,
+                   current_app, flash, g, jsonify, redirect, render_template,
+                   request, send_from_directory, stream_with_context,
+                   template_rendered, url_for)
+from flask.cli import with_appcontext
+from flask_uploads import TEXT, UploadNotAllowed, UploadSet, configure_uploads
 from werkzeug.utils import secure_filename
-from wtforms import SubmitField
 
-from kindle_parser import ClipsParser
-from utils import save2db, collate_pinyin, url_for_page
+from cache import ResponseCache
+from db import get_pool
+from export import iter_csv, iter_ndjson, parse_filters, records
+from jobs import JobQueue
+from metrics import RequestTimer, render as render_metrics
+from search import search
+from snapshot import Snapshot, restore
+from users import current_user, user_database, user_file
+from utils import (fetch_after, fetch_page, init_schema, load_checkpoint,
+                   pinyin_key, read_generation, save2db, save_checkpoint,
+                   url_for_page)
 
-# from config import *
+# 只在用到时才导入的模块（启动更快，见 benchmarks/bench_startup.py）：
+# cover（requests、bs4）在获取封面的任务中，kindle_parser 在解析任务中，
+# pypinyin 在 utils.pinyin_key 中，flask_wtf/wtforms 在 upload_form 中。
 
 
-app = Flask(__name__)
-
-app.config.from_pyfile('config.py')
-# 或许需要加载独立的、根据环境而变化的配置文件
-app.config.from_envvar('FLASK_SETTINGS', silent=True)
-# 向jinja注册一个环境变量，以便在模板中使用此方法
-app.jinja_env.globals['url_for_page'] = url_for_page
+# 视图函数、请求钩子都注册在 bp 上，由 create_app 注册到应用中
+bp = Blueprint('clindle', __name__)
 
 
 # 数据库操作函数
-def connect_db():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
-    return conn
+def connect_db(database=None):
+    """从连接池中取得一个连接，用完后需要归还。"""
+    return get_pool(database or current_app.config['DATABASE']).get()
+
+
+def user():
+    """当前用户，见 users.py。"""
+    return current_user(current_app.config)
 
 
 def get_db():
     """如果当前应用上下文没有数据库连接，
-    则打开一个新的数据库连接。"""
+    则从连接池中取得当前用户的数据库的一个连接。"""
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
-        return g.sqlite_db
+        g.database = user_database(user(), current_app.config)
+        g.sqlite_db = connect_db(g.database)
+        if 'timer' in g:
+            # 统计本次请求中每条SQL的耗时
+            g.sqlite_db.set_trace_callback(g.timer.trace)
+    return g.sqlite_db
+
+
+# 后台任务：解析上传文件和获取封面。这里只注册处理函数，
+# 每个应用的队列由 create_app 建立，保存在 app.extensions 中
+jobs = JobQueue()
+
+
+def _generation(owner):
+    """页面缓存的版本：数据库中该用户的数据版本，所有进程共享。"""
+    return read_generation(get_db(), owner)
+
+
+# 页面缓存，按用户分别缓存，该用户入库和获取封面之后失效；
+# 同 jobs，每个应用的缓存由 create_app 建立
+cache = ResponseCache(scope=user, version=_generation)
+
+
+@jobs.register('ingest')
+def ingest_job(args, progress):
+    """解析上传的文件并存入上传者的数据库。"""
+    from kindle_parser import ClipsParser
+
+    config = current_app.config
+    owner = args.get('user', '')
+    database = user_database(owner, config)
+    kindleparser = ClipsParser(args['filename'],
+                               workers=config['PARSE_WORKERS'],
+                               threshold=config['PARALLEL_PARSE_THRESHOLD'])
+    # 来源为上传时填写的设备名，没有填写时由文件的第一条记录识别设备；
+    # 同一设备的文件只会被追加，从上次解析到的位置继续
+    source = args.get('device') or kindleparser.fingerprint()
+    kindleparser.checkpoint = load_checkpoint(source, owner, database)
+    backup = config['BACKUP_FORMAT']
+    clips = kindleparser.iter_clips(backup=backup == 'json')
+    if backup == 'snapshot':
+        # 只把该用户数据库中还没有的记录追加到该用户的快照中
+        clips = Snapshot(user_file(config['SNAPSHOT_FILE'], owner),
+                         database=database, user=owner).append(clips)
+
+    def _clips():
+        num = 0
+        for num, clip in enumerate(clips, 1):
+            if num % 1000 == 0:
+                progress(num)
+            yield clip
+        progress(num)
+
+    # 流式解析，边解析边写入数据库和备份
+    try:
+        error = save2db(_clips(), database=database, user=owner,
+                        source=source)
+    finally:
+        # 出错时之前的批次也已经写入
+        cache.bump(owner)
+    if error:
+        raise RuntimeError(error)
+    save_checkpoint(source, kindleparser.checkpoint, owner, database)
+
+
+@jobs.register('covers')
+def covers_job(args, progress):
+    """获取所有需要封面的书籍的封面。
+    共用一个数据库时会更新所有用户的书籍，每个用户一个数据库时只更新该用户的。"""
+    from cover import fetch_covers
+
+    config = current_app.config
+    owner = args.get('user', '')
+    try:
+        with get_pool(user_database(owner, config)).connection() as conn:
+            return '{} found, {} failed'.format(
+                *fetch_covers(conn, config, progress=progress))
+    finally:
+        cache.bump(owner if config['DATABASE_PER_USER'] else None)
+
+
+@bp.before_app_request
+def start_jobs():
+    """在第一次处理请求时启动后台任务线程（并恢复未完成的任务），
+    避免 debug 模式下重载器的主进程也执行任务。"""
+    jobs.start()
 
 
-@app.teardown_appcontext
 def close_db(error):
-    """在request结束的时候再次close数据库连接"""
+    """在request结束的时候将数据库连接归还连接池"""
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        g.sqlite_db.set_trace_callback(None)
+        get_pool(g.database).put(g.sqlite_db)
+
+
+# 耗时统计，见 metrics.py
+def _log_slow_query(seconds, sql):
+    current_app.logger.warning('slow query (%.1f ms) in %s: %s', seconds * 1000,
+                               request.endpoint, sql)
+
+
+@bp.before_app_request
+def start_timer():
+    g.timer = RequestTimer(request.endpoint or 'unknown',
+                           current_app.config['SLOW_QUERY_MS'],
+                           _log_slow_query)
+
+
+def _before_render(sender, template, context, **extra):
+    if 'timer' in g:
+        # 之前的SQL到这里结束
+        g.timer.mark()
+        g.render_start = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    if 'render_start' in g:
+        g.timer.rendered(time.perf_counter() - g.pop('render_start'),
+                         template.name)
+
+
+@bp.after_app_request
+def add_server_timing(response):
+    """在响应头中给出本次请求的SQL和模板渲染耗时。"""
+    if 'timer' in g:
+        response.headers['Server-Timing'] = g.timer.server_timing()
+    return response
+
+
+@bp.teardown_app_request
+def stop_timer(error):
+    if 'timer' in g:
+        g.pop('timer').finish()
 
 
 # 初始化数据库
 def init_db():
-    """根据数据库的schema创建数据库。"""
-    conn = get_db()
-    with app.open_resource('schema.sql', 'r') as f:
-        conn.cursor().executescript(f.read())
-    conn.commit()
+    """根据数据库的schema重新创建数据库（清空已有数据）。"""
+    init_schema(get_db(), rebuild=True)
 
 
-@app.cli.command('initdb')
+@click.command('initdb')
+@with_appcontext
 def initdb_comd():
     """初始化数据库"""
     init_db()
 
 
-# 创建upload set并注册配置
+@click.command('restoredb')
+@click.option('--user', default='', help='Restore this user\'s library.')
+@with_appcontext
+def restoredb_comd(user):
+    """从快照重建数据库"""
+    config = current_app.config
+    error = restore(user_file(config['SNAPSHOT_FILE'], user),
+                    user_database(user, config), user)
+    if error:
+        raise click.ClickException(error)
+
+
+@click.command('exportjson')
+@click.argument('filename')
+@click.option('--lines', is_flag=True, help='JSON Lines, one clip per line.')
+@click.option('--user', default='', help='Export this user\'s snapshot.')
+@with_appcontext
+def exportjson_comd(filename, lines, user):
+    """将快照导出为JSON"""
+    num = Snapshot(user_file(current_app.config['SNAPSHOT_FILE'],
+                             user)).export_json(filename, lines)
+    click.echo('{} clips exported to {}'.format(num, filename))
+
+
+# 创建upload set，在 create_app 中注册配置
 clipstxt = UploadSet('clipstxt', TEXT)
-configure_uploads(app, clipstxt)
-# 限制文件大小，同 MAX_CONTENT_LENGTH
-patch_request_class(app, None)
+_UploadForm = None
 
 
-# 设置flask_wtf上传表单
-class UploadForm(FlaskForm):
-    clipsfile = FileField(validators=[
-        FileRequired('wtf:请选择文件'),
-        FileAllowed(clipstxt, 'wtf:出错，请检查上传文件格式。')])
-    submit = SubmitField('上传')
+def upload_form():
+    """设置flask_wtf上传表单，第一次使用时才导入 flask_wtf 和 wtforms。"""
+    global _UploadForm
+    if _UploadForm is None:
+        from flask_wtf import FlaskForm
+        from flask_wtf.file import FileAllowed, FileField, FileRequired
+        from wtforms import StringField, SubmitField
+        from wtforms.validators import Length
 
+        class UploadForm(FlaskForm):
+            clipsfile = FileField(validators=[
+                FileRequired('wtf:请选择文件'),
+                FileAllowed(clipstxt, 'wtf:出错，请检查上传文件格式。')])
+            # 可选，不填写时由文件内容识别设备
+            device = StringField(validators=[
+                Length(max=64, message='wtf:设备名太长')])
+            submit = SubmitField('上传')
 
-@app.errorhandler(413)
+        _UploadForm = UploadForm
+    return _UploadForm()
+
+
+@bp.app_errorhandler(413)
 def entity_too_large(error):
     flash('File size are too large!')
-    return redirect(url_for('index')), 413
+    return redirect(url_for('clindle.index')), 413
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(error):
     return render_template('404.html'), 404
 
 
 # 视图函数 view functions
-@app.route('/', defaults={'page': 1})
-@app.route('/page/<int:page>')
+@bp.route('/', defaults={'page': 1})
+@bp.route('/page/<int:page>')
+# 页面中有上传表单的 CSRF token 和后台任务的进度
+@cache.cached(per_session=True, unless=lambda: jobs.busy(user=user()))
 def index(page):
     conn = get_db()
     cur = conn.cursor()
-    conn.create_collation('pinyin', collate_pinyin)
 
     # pagination
     # use "try" expression in case there are no tables at all
     # before uploading text document.
     try:
         # get the count of books
-        cur.execute('select count(title) from Books;')
-        book_count = cur.fetchone()[0]
+        cur.execute('select bookcount from Library where user_id = ?;',
+                    (user(),))
+        row = cur.fetchone()
+        book_count = row[0] if row else 0
         # number of pagination
-        page_num = math.ceil(book_count / app.config['PER_PAGE_BOOK'])
-        if page not in range(1, page_num + 1):
+        page_num = math.ceil(book_count / current_app.config['PER_PAGE_BOOK'])
+        # 新用户还没有书籍时也显示第一页
+        if page not in range(1, max(page_num, 1) + 1):
             abort(404)
     except sqlite3.Error:
         page_num = 0
@@ -130,39 +297,29 @@ def index(page):
 
     # get only fixed number of records as specified by 'PER_PAGE' from database
     try:
-        # counts of clips, notes and marks of one book are queried.
-        # And yes, this is a VERY LONG SQL statement!
-        sql = (
-            'SELECT cn_num.id, cn_num.title, cn_num.author, cn_num.cover, '
-            'cn_num.clipnum, cn_num.notenum, COUNT(m.id) AS marknum '
-            'FROM '
-            '   (SELECT c_num.id , c_num.title, c_num.author, c_num.cover, '
-            '   c_num.clipnum, COUNT(n.id) AS notenum '
-            '   FROM '
-            '       (SELECT b.id, b.title, b.author, b.cover, '
-            '       COUNT(c.id) AS clipnum '
-            '       FROM '
-            '           Books AS b LEFT JOIN Clips AS c ON b.id = c.bookid '
-            '       GROUP BY b.id '
-            '       ORDER BY b.title COLLATE pinyin LIMIT ? OFFSET ?) AS c_num'
-            '   LEFT JOIN Notes AS n ON c_num.id = n.bookid '
-            '   GROUP BY c_num.id) AS cn_num '
-            'LEFT join Marks AS m ON cn_num.id = m.bookid '
-            'GROUP BY cn_num.id ORDER BY cn_num.title COLLATE pinyin;'
-        )
-        cur.execute(
-            sql, (app.config['PER_PAGE_BOOK'],
-                  app.config['PER_PAGE_BOOK'] * (page - 1)))
-        books = cur.fetchall()
+        # counts of clips, notes and marks are kept in Books by triggers,
+        # so this is a plain read through the titlekey index.
+        books = fetch_page(cur, 'Books', ('titlekey', 'id'), page,
+                           current_app.config['PER_PAGE_BOOK'],
+                           where='user_id = ?', params=(user(),))
     except sqlite3.Error:
         books = {}
 
-    form = UploadForm()
+    form = upload_form()
     return render_template('index.html', books=books, form=form,
-                           page=page, page_num=page_num)
+                           page=page, page_num=page_num,
+                           jobs=jobs.active(user=user()))
+
 
+# 一本书的标注及其笔记，按位置排序
+_CLIPS_OUTER = ('select c.id, c.pos, c.time, c.content as clipcnt, '
+                'n.content as notecnt '
+                'from ({}) as c left join Notes as n on c.id = n.clipid '
+                'order by c.startpos, c.id;')
 
-@app.route('/book/<int:book_id>')
+
+@bp.route('/book/<int:book_id>')
+@cache.cached()
 def show_clips(book_id):
     """return clips/notes/marks of one book.
     """
@@ -172,130 +329,272 @@ def show_clips(book_id):
     conn = get_db()
     cur = conn.cursor()
 
-    # get book cover
-    cur.execute('select cover from Books where id = ?;', (book_id,))
-    cover = cur.fetchone()
-    cover = cover[0].replace('AA100', 'AA160') if cover else None
-    
+    # get book title, cover and counts of clips and marks
+    cur.execute('select title, cover, clipnum, marknum from Books '
+                'where id = ? and user_id = ?;', (book_id, user()))
+    book = cur.fetchone()
+    if not book:
+        abort(404)
+    title = book['title']
+    cover = url_for('.cover_pic', filename=book['cover']) \
+        if book['cover'] else None
+
     # clips pagination
-    cur.execute('select count(id) from Clips where bookid = ?;', (book_id,))
-    clip_count = cur.fetchone()[0]
+    clip_count = book['clipnum']
     # number of clips pagination
-    clip_pagenum = math.ceil(clip_count / app.config['PER_PAGE_CLIP'])
+    clip_pagenum = math.ceil(clip_count / current_app.config['PER_PAGE_CLIP'])
     if clippage not in range(1, clip_pagenum + 1):
             abort(404)
     # get clips and associated notes.
-    cur.execute(
-        'select c.pos, c.time, c.content as clipcnt, n.content as notecnt '
-        'from Clips as c left join Notes as n '
-        'on c.id = n.clipid where c.bookid = ? '
-        'order by startpos limit ? offset ?;',
-        (book_id, app.config['PER_PAGE_CLIP'],
-         app.config['PER_PAGE_CLIP'] * (clippage - 1)))
-    clips = cur.fetchall()
-    cur.execute('select title from Books where id = ?;', (book_id,))
-    title = cur.fetchone()
-    if title:
-        title = title[0]
-    else:
-        abort(404)
+    clips = fetch_page(
+        cur, 'Clips', ('startpos', 'id'), clippage,
+        current_app.config['PER_PAGE_CLIP'], 'clippage', 'bookid = ?', (book_id,),
+        outer=_CLIPS_OUTER)
+    # 之后的标注在滚动到底部时由 book_clips_more 加载
+    more_url = url_for('.book_clips_more', book_id=book_id,
+                       after=clips[-1]['id']) \
+        if clips and clippage < clip_pagenum else None
 
     # marks pagination
-    cur.execute('select count(id) from Marks where bookid = ?;', (book_id,))
-    mark_count = cur.fetchone()[0]
-    mark_pagenum = math.ceil(mark_count / app.config['PER_PAGE_MARK'])
+    mark_count = book['marknum']
+    mark_pagenum = math.ceil(mark_count / current_app.config['PER_PAGE_MARK'])
     if mark_count and markpage not in range(1, mark_pagenum + 1):
         abort(404)
     # get marks if any.
-    cur.execute(
-        'select pos, time from Marks where bookid = ? '
-        'order by startpos limit ? offset ?;',
-        (book_id, app.config['PER_PAGE_MARK'],
-         app.config['PER_PAGE_MARK'] * (markpage - 1)))
-    marks = cur.fetchall()
-
-    return render_template('bookclips.html', clips=clips, 
+    marks = fetch_page(cur, 'Marks', ('startpos', 'id'), markpage,
+                       current_app.config['PER_PAGE_MARK'], 'markpage',
+                       'bookid = ?', (book_id,))
+
+    return render_template('bookclips.html', clips=clips, more_url=more_url,
                            title=title, cover=cover,
                            marks=marks, page=page, book_id=book_id,
                            clip_pagenum=clip_pagenum, clippage=clippage,
                            mark_pagenum=mark_pagenum, markpage=markpage)
 
 
+@bp.route('/book/<int:book_id>/more')
+@cache.cached()
+def book_clips_more(book_id):
+    """标注id为 after 之后的 PER_BATCH_CLIP 条标注，HTML片段，
+    不包括页面的其他部分（封面、书名、书签等）
+    The next batch of clips after a cursor, as an HTML fragment."""
+    after = request.args.get('after', type=int)
+    cur = get_db().cursor()
+    cur.execute('select 1 from Books where id = ? and user_id = ?;',
+                (book_id, user()))
+    if not cur.fetchone():
+        abort(404)
+    batch = current_app.config['PER_BATCH_CLIP']
+    clips = fetch_after(cur, 'Clips', ('startpos', 'id'), after, batch,
+                        'bookid = ?', (book_id,), outer=_CLIPS_OUTER)
+    # 一条标注可能有多条笔记（多行），按标注数判断是否还有下一批
+    more_url = url_for('.book_clips_more', book_id=book_id,
+                       after=clips[-1]['id']) \
+        if len({clip['id'] for clip in clips}) == batch else None
+    return render_template('_clips.html', clips=clips, more_url=more_url)
+
+
+@bp.route('/search')
+def search_clips():
+    """全文检索标注和笔记
+    Full-text search over clips and notes."""
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    total, results = 0, []
+    if query:
+        try:
+            total, results = search(get_db(), query, page,
+                                    current_app.config['PER_PAGE_SEARCH'], user())
+        except sqlite3.Error:
+            # 还没有上传过文件
+            pass
+    page_num = math.ceil(total / current_app.config['PER_PAGE_SEARCH'])
+    if page_num and page not in range(1, page_num + 1):
+        abort(404)
+    return render_template('search.html', query=query, results=results,
+                           total=total, page=page, page_num=page_num)
+
+
 # ------File upload------
 # --使用flask-uploads扩展上传文件--
-@app.route('/upload', methods=['POST'])
+@bp.route('/upload', methods=['POST'])
 def upload():
     """
     上传'My Clippings.txt'文档，根据日期重命名，
     并保存至本地'backup_file'文件夹；
-    调用解析函数，将解析内容存入json文件和数据库；然后刷新索引页面。
+    提交后台任务，将解析内容流式存入快照（或json文件）和数据库；然后刷新索引页面。
     Upload 'My Clippings.txt' file, rename according to datetime,
     and save to local 'backup_file' folder.
-    Use parsing function and save parsed content to json file and database.
-    Then refresh the webpage.
+    Submit a background job to parse it and save parsed content to
+    the snapshot (or json file) and database. Then refresh the webpage.
     """
-    form = UploadForm()
+    form = upload_form()
     if form.validate_on_submit():
         try:
             f = form.clipsfile.data
             # 使用pypinyin将中文转换为拼音字母
-            f_name = secure_filename(''.join(lazy_pinyin(f.filename)))
+            f_name = secure_filename(pinyin_key(f.filename))
             # 根据日期&时间重命名文件
             f_rename = ''.join(
                 [datetime.now().strftime('%Y%m%d_%H%M%S_'), f_name])
             filename = clipstxt.save(f, name=f_rename)
-            kindleparser = ClipsParser(filename)
-            clips = kindleparser.parse()
-            error = save2db(clips)
-            if error:
-                flash('Upload success. But:<br> {}'.format(error))
-            else:
-                flash('Upload success.')
+            # 解析和入库在后台任务中进行
+            jobs.submit('ingest', filename=filename,
+                        device=(form.device.data or '').strip(), user=user())
+            flash('Upload success. 正在后台解析……')
         except UploadNotAllowed:
             # 经过上面form.validate_on_submit()，下面这两句应该不会执行了
             flash('出错：UploadNotAllowed。<br>请检查文件格式是否正确。')
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
     else:
-        for error in form.clipsfile.errors:
-            flash(error)
-    return redirect(url_for('index'))
+        for field in (form.clipsfile, form.device):
+            for error in field.errors:
+                flash(error)
+    return redirect(url_for('.index'))
 
 
-@app.route('/api/getcover', methods=['GET'])
+@bp.route('/api/getcover', methods=['GET'])
 def get_cover():
-    """获取书籍封面
-    Get book covers."""
+    """获取书籍封面（后台任务）
+    Get book covers in a background job."""
     page = request.args.get('idxpage', 1)
+    jobs.submit('covers', user=user())
+    return redirect(url_for('.index', page=page))
+
+
+@bp.route('/api/jobs/<int:job_id>')
+def job_status(job_id):
+    """后台任务的状态和进度
+    Status and progress of a background job."""
+    job = jobs.get(job_id)
+    # 只能查看自己提交的任务
+    if job is None or job['args'].get('user', '') != user():
+        abort(404)
+    return jsonify(job)
+
+
+@bp.route('/api/books')
+@cache.cached()
+def api_books():
+    """所有书籍及其标注/笔记/书签数，按书名拼音排序
+    All books with their clip/note/mark counts."""
+    try:
+        rows = get_db().execute(
+            'select id, title, author, cover, clipnum, notenum, marknum '
+            'from Books where user_id = ? order by titlekey, id;',
+            (user(),)).fetchall()
+    except sqlite3.Error:
+        # 还没有上传过文件
+        rows = []
+    return jsonify(books=[dict(row) for row in rows])
+
+
+@bp.route('/api/books/<int:book_id>/clips')
+@cache.cached()
+def api_book_clips(book_id):
+    """一本书的标注、笔记和书签，可按 type/since/until 筛选
+    Clips, notes and marks of one book, filtered by type and date."""
+    try:
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('select title from Books;')
-    titles = cur.fetchall()
-
-    PRE_URL = 'https://www.amazon.cn/s/ref=nb_sb_noss?__mk_zh_CN=亚马逊网站&url=search-alias%3Ddigital-text&field-keywords='
-    for title in titles:
-        search_url = PRE_URL + title[0]
-        headers = {'user-agent': random.choice(app.config['USER_AGENT'])}
-        respns = requests.get(search_url, headers=headers, timeout=1)
-        soup = BeautifulSoup(respns.text, 'html.parser')
-        img_tag = soup.select('#resultsCol ul li:nth-of-type(1) img')
-        # print(img_tag)
-        if img_tag:
-            src = img_tag[0]['src']
-            src_split = re.split(r'\._AA\d+_\.', src)
-            src_split.insert(1, '._AA100_.')
-            src = ''.join(src_split)
-        else:
-            src = None
-        # print(src)
-        # print('__________')
-        cur.execute('update Books set cover = ? where title = ?;',
-                    (src, title[0]))
-    conn.commit()
-    return redirect(url_for('index', page=page))
+    try:
+        book = conn.execute('select id, title, author, cover from Books '
+                            'where id = ? and user_id = ?;',
+                            (book_id, user())).fetchone()
+    except sqlite3.Error:
+        book = None
+    if book is None:
+        return jsonify(error='Book not found'), 404
+    filters['book'] = book_id
+    return jsonify(book=dict(book), clips=records(conn, filters))
+
+
+@bp.route('/api/export')
+def api_export():
+    """流式导出整个书库（或按 type/since/until/book 筛选），
+    format 为 ndjson（默认）或 csv
+    Stream the whole library as NDJSON or CSV."""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify(error="format: expected 'ndjson' or 'csv'"), 400
+    try:
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    filters['user'] = user()
+    database = user_database(filters['user'], current_app.config)
+    iter_text, mimetype = (iter_ndjson, 'application/x-ndjson') \
+        if fmt == 'ndjson' else (iter_csv, 'text/csv')
+
+    def generate():
+        # 使用单独的连接：整个导出在一个查询中完成，读到的是同一时刻的数据
+        with get_pool(database).connection() as conn:
+            yield from iter_text(conn, filters)
+
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=clindle.{}'.format(fmt)
+    return response
+
+
+@bp.route('/metrics')
+def metrics():
+    """耗时直方图和计数器，Prometheus 文本格式
+    Histograms and counters in the Prometheus text format."""
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@bp.route('/covers/<path:filename>')
+def cover_pic(filename):
+    """本地保存的封面图片
+    Serve cover images downloaded to COVERPIC_FOLDER."""
+    return send_from_directory(current_app.config['COVERPIC_FOLDER'], filename)
+
+
+def create_app(settings=None):
+    """创建并配置应用。配置依次来自 config.py、环境变量 FLASK_SETTINGS
+    指向的文件和 settings（字典）。
+    flask 命令会自动调用本函数，例如 flask --app clindle run；
+    gunicorn 等可以使用 'clindle:create_app()'。
+    """
+    app = Flask(__name__)
+
+    app.config.from_pyfile('config.py')
+    # 或许需要加载独立的、根据环境而变化的配置文件
+    app.config.from_envvar('FLASK_SETTINGS', silent=True)
+    if settings:
+        app.config.from_mapping(settings)
+    # 向jinja注册一个环境变量，以便在模板中使用此方法
+    app.jinja_env.globals['url_for_page'] = url_for_page
+
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if limit is not None and app.config['PARALLEL_PARSE_THRESHOLD'] >= limit:
+        app.logger.warning(
+            'PARALLEL_PARSE_THRESHOLD (%d) >= MAX_CONTENT_LENGTH (%d): '
+            'uploads will never be parsed in parallel',
+            app.config['PARALLEL_PARSE_THRESHOLD'], limit)
+
+    jobs.init_app(app)
+    cache.init_app(app)
+    # 上传文件的大小由 MAX_CONTENT_LENGTH 限制
+    configure_uploads(app, clipstxt)
+
+    app.register_blueprint(bp)
+    # 在request结束的时候将数据库连接归还连接池
+    app.teardown_appcontext(close_db)
+    # 模板渲染耗时
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    for command in (initdb_comd, restoredb_comd, exportjson_comd):
+        app.cli.add_command(command)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(
+    create_app().run(
         port=5000,
         debug=True
     )
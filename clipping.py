@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+clipping
+--------
+解析结果在内存中的表示。
+之前每条记录是一个有六个字符串键的字典，整个文件解析到内存中时还要以32个字符的
+十六进制md5为键，每条记录在写入数据库之前就要占用几百字节。Clip 用 __slots__
+保存各字段：md5为16字节的摘要，类型（'标注'、'笔记'、'书签'）驻留为同一个字符串，
+起止位置为整数。
+Clip 同时支持 clip['type'] 形式的读取，save2db 等按字典使用的代码不需要修改；
+写入 JSON 备份时用 as_dict()/dump_json() 转换为之前的字典格式。
+"""
+import json
+import sys
+
+# 与之前的字典相同的键和顺序
+FIELDS = ('type', 'pos', 'start_pos', 'end_pos', 'time', 'content')
+
+
+class Clip(object):
+    __slots__ = ('digest',) + FIELDS
+
+    def __init__(self, digest, type, pos, start_pos, end_pos, time, content):
+        self.digest = digest
+        self.type = sys.intern(type) if type is not None else None
+        self.pos = pos
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self.time = time
+        self.content = content
+
+    @property
+    def index(self):
+        """十六进制的md5，即数据库中的 md5 列。"""
+        return self.digest.hex()
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in FIELDS else default
+
+    def keys(self):
+        return FIELDS
+
+    def as_dict(self):
+        """之前的字典格式：{'type': ..., 'pos': ..., ..., 'content': ...}。"""
+        return {key: getattr(self, key) for key in FIELDS}
+
+    def __eq__(self, other):
+        if isinstance(other, Clip):
+            return self.digest == other.digest and \
+                all(getattr(self, key) == getattr(other, key)
+                    for key in FIELDS)
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # 多进程解析时结果要传回主进程，按位置参数序列化比默认的方式更小，
+        # 反序列化时 type 也会重新驻留
+        return Clip, (self.digest,) + tuple(getattr(self, key)
+                                            for key in FIELDS)
+
+    def __repr__(self):
+        return 'Clip({}, {!r})'.format(self.index, self.as_dict())
+
+
+def _book_dict(clips):
+    return {clip.index: clip.as_dict() for clip in clips.values()}
+
+
+def as_dicts(book_clips):
+    """把 ClipsParser.parse() 返回的 {bookname: {digest: Clip}}
+    转换为之前的 {bookname: {index: dict}}。"""
+    return {bookname: _book_dict(clips)
+            for bookname, clips in book_clips.items()}
+
+
+def dump_json(book_clips, f):
+    """与 json.dump(as_dicts(book_clips), f) 的输出相同，
+    但每次只转换一本书，不会在写入备份时又占用之前那么多的内存。"""
+    f.write('{')
+    for num, (bookname, clips) in enumerate(book_clips.items()):
+        f.write('{}{}: {}'.format(', ' if num else '', json.dumps(bookname),
+                                  json.dumps(_book_dict(clips))))
+    f.write('}')
@@ -8,12 +8,100 @@ DATABASE = os.path.join(os.getcwd(), 'data', 'clippings.db')
 SECRET_KEY = 'development_key'
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'backup_file')
 JSONFILE_FOLDER = os.path.join(os.getcwd(), 'data', 'json')
+SNAPSHOT_FILE = os.path.join(os.getcwd(), 'data', 'clips.snap')
 COVERPIC_FOLDER = os.path.join(os.getcwd(), 'data', 'pics')
 ALLOWED_EXTENSIONS = set(['txt'])
-MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+# 上传文件的大小上限，需要大于 PARALLEL_PARSE_THRESHOLD，否则上传的文件
+# 永远不会用多进程解析（create_app() 中检查）
+MAX_CONTENT_LENGTH = 64 * 1024 * 1024
 PER_PAGE_BOOK = 3
 PER_PAGE_CLIP = 5
 PER_PAGE_MARK = 5
+PER_PAGE_SEARCH = 10
+# 书籍页面滚动到底部时每次加载的标注数
+PER_BATCH_CLIP = 20
+
+# 待解析的内容超过这个大小（字节）时使用多进程解析；parse big files in parallel
+PARALLEL_PARSE_THRESHOLD = 32 * 1024 * 1024
+# 解析使用的进程数，None 表示使用全部CPU
+PARSE_WORKERS = None
+
+# 全文检索分词器，见 search.py；full-text search tokenizer
+SEARCH_TOKENIZER = 'trigram'
+
+# 多用户，见 users.py；multiple users
+# None: 单用户；'header': 用户名由反向代理放在 USER_HEADER 请求头中；
+# 'session': 每个浏览器会话一个匿名用户
+USER_MODE = None
+USER_HEADER = 'X-Remote-User'
+# 每个用户一个数据库文件（放在 USER_DATABASE_FOLDER），不同用户可以同时入库；
+# False 时所有用户共用 DATABASE
+DATABASE_PER_USER = False
+USER_DATABASE_FOLDER = os.path.join(os.getcwd(), 'data', 'users')
+
+# 数据库连接；database connections (see db.py)
+DB_POOL_SIZE = 4
+# 最多同时打开这么多个数据库文件的连接池，超过时关闭最久未使用的
+DB_MAX_POOLS = 64
+# 等待写锁的秒数
+DB_TIMEOUT = 30
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = {
+    # WAL: 写入时不阻塞读取
+    'journal_mode': 'wal',
+    # WAL 模式下 normal 已经可以保证数据库不损坏
+    'synchronous': 'normal',
+    # 负数表示 KiB
+    'cache_size': -16 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+# 入库时每批（一个事务）写入的记录数；rows per executemany batch
+BULK_BATCH_SIZE = 5000
+# 入库期间临时使用的 pragma，结束后恢复，例如：
+# {'synchronous': 'off'}  断电时可能丢失正在写入的数据，重新上传即可
+BULK_PRAGMAS = {}
+
+# 合并同一条标注/笔记的多个版本（扩展标注、修改笔记时 Kindle 会追加新记录），
+# 见 dedupe.py：时间相差不超过这么多秒的才合并，None 表示不合并
+DEDUPE_WINDOW = 60 * 60
+
+# 上传解析结果的备份，见 snapshot.py；backup of parsed clips
+# 'snapshot': 只把新的记录追加到 SNAPSHOT_FILE；
+# 'json': 每次上传写一个完整的 JSON Lines 文件到 JSONFILE_FOLDER；None: 不备份
+BACKUP_FORMAT = 'snapshot'
+# 快照中每帧（一次 zlib 压缩）的记录数
+SNAPSHOT_FRAME_SIZE = 5000
+
+# 页面缓存，见 cache.py；response cache
+# 命中时不执行页面的查询、不渲染模板，但仍要从 Generations 表读取数据版本
+# （书籍列表还要查询 Jobs 表），这样多个进程入库后都能立即看到
+# 内存中缓存的页面数，0 表示不缓存
+RESPONSE_CACHE_SIZE = 256
+# 秒；不应超过 CSRF token 的有效期（WTF_CSRF_TIME_LIMIT，默认3600）
+RESPONSE_CACHE_TTL = 600
+# 同时把页面写入这个目录，None 表示只使用内存
+RESPONSE_CACHE_FOLDER = None
+
+# 慢查询日志：请求中耗时超过这么多毫秒的SQL记录到日志，None 表示不记录；
+# slow query log threshold (ms), see metrics.py
+SLOW_QUERY_MS = None
+
+# 后台任务线程数；background job workers
+JOB_WORKERS = 2
+# 运行中的任务每 JOB_HEARTBEAT 秒更新一次心跳，超过 JOB_STALE 秒没有更新的
+# 任务在其他进程启动时重新排队；job heartbeat interval and staleness (seconds)
+JOB_HEARTBEAT = 10
+JOB_STALE = 60
+
+# 获取封面；book cover fetching
+COVER_SEARCH_URL = 'https://www.amazon.cn/s/ref=nb_sb_noss?__mk_zh_CN=亚马逊网站&url=search-alias%3Ddigital-text&field-keywords='
+COVER_WORKERS = 8
+COVER_TIMEOUT = 3
+# 失败后的重试间隔（秒），每失败一次加倍，最多 COVER_RETRY_MAX
+COVER_RETRY_BASE = 60 * 60
+COVER_RETRY_MAX = 7 * 24 * 60 * 60
 
 # flask-uploads 扩展设置；flask-uploads extension configures
 UPLOADED_CLIPSTXT_DEST = UPLOAD_FOLDER
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+cover
+-----
+获取书籍封面：用有限大小的线程池并发地搜索封面，图片只下载一次并保存在
+COVERPIC_FOLDER 中，由本地提供访问。
+搜索结果按书名缓存在 Covers 表中，没找到或请求失败的书名也会被缓存，
+并按失败次数指数退避，到期之后才会重试。
+"""
+import hashlib
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from bs4 import BeautifulSoup
+
+from metrics import COVER_FETCH_SECONDS
+from utils import bump_generation
+
+
+def _search(title, config):
+    """在搜索结果页中查找第一本书的封面url，没有结果时返回None。"""
+    headers = {'user-agent': random.choice(config['USER_AGENT'])}
+    respns = requests.get(config['COVER_SEARCH_URL'] + title,
+                          headers=headers, timeout=config['COVER_TIMEOUT'])
+    respns.raise_for_status()
+    soup = BeautifulSoup(respns.text, 'html.parser')
+    img_tag = soup.select('#resultsCol ul li:nth-of-type(1) img')
+    # 没有 src 的 img（例如占位图）也视为没有封面
+    src = img_tag[0].get('src') if img_tag else None
+    if not src:
+        return None
+    # 统一获取 160px 大小的封面，书籍列表和书籍页面共用
+    return re.sub(r'\._AA\d+_\.', '._AA160_.', src)
+
+
+def _download(title, src, config):
+    """下载封面图片，返回保存在 COVERPIC_FOLDER 中的文件名。"""
+    headers = {'user-agent': random.choice(config['USER_AGENT'])}
+    respns = requests.get(src, headers=headers,
+                          timeout=config['COVER_TIMEOUT'])
+    respns.raise_for_status()
+    ext = os.path.splitext(src.split('?')[0])[1] or '.jpg'
+    filename = hashlib.md5(title.encode('utf-8')).hexdigest() + ext
+    folder = config['COVERPIC_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    tmpname = os.path.join(folder, filename + '.part')
+    with open(tmpname, 'wb') as f:
+        f.write(respns.content)
+    os.replace(tmpname, os.path.join(folder, filename))
+    return filename
+
+
+def _fetch(title, config):
+    """在工作线程中执行：返回 (title, src, filename)，失败时后两者为None。
+    不会抛出异常，一本书出错不影响其他书的结果写入。"""
+    start = time.perf_counter()
+    result = 'missing'
+    try:
+        src = _search(title, config)
+        if src:
+            filename = _download(title, src, config)
+            result = 'found'
+            return title, src, filename
+    except Exception:
+        # 网络错误、页面结构变化导致的解析错误等，按失败处理，稍后重试
+        result = 'error'
+    finally:
+        COVER_FETCH_SECONDS.observe(time.perf_counter() - start,
+                                    result=result)
+    return title, None, None
+
+
+def pending_titles(conn, now=None):
+    """返回需要获取封面的书名：从未查找过的，以及失败后已到重试时间的。"""
+    now = time.time() if now is None else now
+    cur = conn.execute(
+        'select b.title from Books as b left join Covers as c '
+        'on b.title = c.title '
+        'where c.title is null or (c.filename is null and c.retry <= ?);',
+        (now,))
+    return [row[0] for row in cur]
+
+
+def fetch_covers(conn, config, titles=None, progress=None):
+    """并发获取 titles（默认为 pending_titles()）的封面，结果写入 Covers 表，
+    然后用缓存更新 Books.cover。返回 (成功数, 失败数)。
+    progress(done, total) 在每本书处理完后调用。
+    """
+    if titles is None:
+        titles = pending_titles(conn)
+    found = failed = 0
+    if titles:
+        with ThreadPoolExecutor(max_workers=config['COVER_WORKERS']) as pool:
+            futures = [pool.submit(_fetch, title, config) for title in titles]
+            # sqlite连接只在当前线程中使用
+            for future in as_completed(futures):
+                title, src, filename = future.result()
+                if progress:
+                    progress(found + failed + 1, len(titles))
+                now = time.time()
+                if filename:
+                    found += 1
+                    conn.execute(
+                        'insert or replace into Covers '
+                        'values(?, ?, ?, 0, 0, ?);',
+                        (title, src, filename, now))
+                    continue
+                failed += 1
+                row = conn.execute('select fails from Covers where title = ?;',
+                                   (title,)).fetchone()
+                fails = (row[0] if row else 0) + 1
+                delay = min(config['COVER_RETRY_BASE'] * 2 ** (fails - 1),
+                            config['COVER_RETRY_MAX'])
+                conn.execute(
+                    'insert or replace into Covers '
+                    'values(?, null, null, ?, ?, ?);',
+                    (title, fails, now + delay, now))
+    cur = conn.execute('update Books set cover = (select filename from Covers '
+                       'where Covers.title = Books.title) where cover is null '
+                       'and exists (select 1 from Covers '
+                       'where Covers.title = Books.title '
+                       'and filename is not null);')
+    if cur.rowcount:
+        # 封面显示在所有用户的书籍列表中
+        bump_generation(conn)
+    conn.commit()
+    return found, failed
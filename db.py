@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+db
+--
+数据库连接层，clindle.py、utils.py 和后台任务共用。
+- 每个数据库文件一个小型连接池，连接在请求之间复用，
+  sqlite3 在每个连接上缓存已编译的语句（cached_statements）；
+- 每个用户一个数据库文件时，只保留最近使用的 DB_MAX_POOLS 个连接池；
+- WAL 日志模式，上传入库时不阻塞页面的读取；
+- 连接创建时设置 synchronous/cache_size/mmap_size 等 pragma，
+  并注册全文检索用到的 bigrams() 函数。
+"""
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import (DB_CACHED_STATEMENTS, DB_MAX_POOLS, DB_POOL_SIZE,
+                    DB_PRAGMAS, DB_TIMEOUT)
+from search import bigrams
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+
+
+def connect(database):
+    """打开一个设置好 pragma 和 SQL 函数的新连接。
+    连接可以在线程之间传递，但同一时间只能由一个线程使用。
+    """
+    conn = sqlite3.connect(database, timeout=DB_TIMEOUT,
+                           cached_statements=DB_CACHED_STATEMENTS,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for name, value in DB_PRAGMAS.items():
+        conn.execute('pragma {} = {};'.format(name, value))
+    # SearchShort 的触发器中使用，见 search.py
+    conn.create_function('bigrams', 1, bigrams, deterministic=True)
+    return conn
+
+
+def execute_script(conn, script):
+    """逐条执行 SQL 脚本，与 conn.executescript() 不同，不会先提交当前的事务。"""
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        # 触发器中的分号不是语句的结尾
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ''
+
+
+class Pool(object):
+    """最多保留 size 个空闲连接的连接池。"""
+    def __init__(self, database, size=DB_POOL_SIZE):
+        self.database = database
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.database)
+
+    def put(self, conn):
+        """归还连接，未提交的事务会被回滚；池满或已关闭时关闭连接。"""
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """关闭空闲的连接，正在使用的连接在归还时关闭。"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+
+_pools = OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(database):
+    """返回数据库文件 database 的连接池。"""
+    with _pools_lock:
+        pool = _pools.get(database)
+        if pool is None:
+            pool = _pools[database] = Pool(database)
+            while len(_pools) > DB_MAX_POOLS:
+                _pools.popitem(last=False)[1].close()
+        else:
+            _pools.move_to_end(database)
+        return pool
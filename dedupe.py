@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+dedupe
+------
+合并同一条标注/笔记的多个版本。
+Kindle 在扩展或缩短一条标注、修改一条笔记时都会追加一条新记录，
+md5 不同，所以入库后每个版本都会作为单独的标注显示。
+- 标注：同一本书中，起始位置相同、或一个位置区间包含另一个，
+  并且标注时间相差不超过 window 秒的，视为同一条标注的不同版本；
+- 笔记：同一本书中位置相同、时间相差不超过 window 秒的，视为同一条笔记。
+只保留时间最晚的版本（时间相同时保留后入库的）。
+标注按 (startpos, endpos desc) 排序后扫描一遍：包含当前区间的标注
+一定排在它前面，且结束位置不小于当前的起始位置，只需要检查这些“仍然有效”的区间。
+新版本通常紧跟在旧版本之后，入库时先用 superseded() 在每批记录中合并，
+旧版本不写入数据库、也不进入全文索引（从索引中删除比写入还慢）；
+跨批次、跨上传的版本在全部写入之后由 dedupe_clips() 在数据库中合并。
+"""
+from datetime import datetime
+
+
+def _seconds(timestr):
+    """'YYYY-MM-DD HH:MM:SS' 转换为秒，格式不对时返回None（不参与合并）。"""
+    try:
+        return datetime.fromisoformat(timestr).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _sweep(rows, window):
+    """rows 为按 (startpos, endpos desc) 排序的 (id, startpos, endpos, 时间)，
+    返回被取代的 {旧id: 保留的id}。"""
+    parent = list(range(len(rows)))
+    # 结束位置还没有越过当前起始位置的区间的下标
+    active = []
+    for i, (_, start, end, seconds) in enumerate(rows):
+        active = [j for j in active if rows[j][2] >= start]
+        if seconds is not None:
+            for j in active:
+                # 排序保证 rows[j] 的起始位置 <= start；
+                # 结束位置不小于 end 即包含当前区间（起始位置相同时也成立）
+                other = rows[j][3]
+                if rows[j][2] >= end and other is not None and \
+                        abs(other - seconds) <= window:
+                    parent[_find(parent, i)] = _find(parent, j)
+        active.append(i)
+
+    groups = {}
+    for i in range(len(rows)):
+        groups.setdefault(_find(parent, i), []).append(i)
+    superseded = {}
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        keep = max(members, key=lambda i: (rows[i][3], rows[i][0]))
+        for i in members:
+            if i != keep:
+                superseded[rows[i][0]] = rows[keep][0]
+    return superseded
+
+
+def superseded(rows, window, fields):
+    """返回 rows 中被同一批中的新版本取代的标注的下标集合。
+    fields(row) 返回 (bookid, startpos, endpos, time)。"""
+    books = {}
+    for i, row in enumerate(rows):
+        bookid, start, end, time = fields(row)
+        books.setdefault(bookid, []).append(
+            (i, start, start if end is None else end, _seconds(time)))
+    old = set()
+    for items in books.values():
+        if len(items) > 1:
+            items.sort(key=lambda item: (item[1], -item[2], item[0]))
+            old.update(_sweep(items, window))
+    return old
+
+
+def _move_notes(conn, old, keep):
+    """把关联到标注 old 的笔记改为关联到 keep。
+    keep 已经关联了同一条笔记时删除其中id较大的一行：全文索引中的是同一 md5
+    id最小的一行，见 search.py。"""
+    for noteid, md5 in conn.execute('select id, md5 from Notes '
+                                    'where clipid = ?;', (old,)).fetchall():
+        row = conn.execute('select id from Notes '
+                           'where clipid = ? and md5 = ?;',
+                           (keep, md5)).fetchone()
+        if row is not None and row[0] < noteid:
+            conn.execute('delete from Notes where id = ?;', (noteid,))
+            continue
+        if row is not None:
+            conn.execute('delete from Notes where id = ?;', (row[0],))
+        conn.execute('update Notes set clipid = ? where id = ?;',
+                     (keep, noteid))
+
+
+def dedupe_clips(conn, bookids, window):
+    """合并 bookids 中各书籍的重复标注，原来关联到旧版本的笔记改为关联到保留的版本。
+    在调用方的事务中执行，返回删除的标注数。"""
+    removed = 0
+    for bookid in bookids:
+        rows = [(clipid, start, start if end is None else end,
+                 _seconds(time))
+                for clipid, start, end, time in conn.execute(
+                    'select id, startpos, endpos, time from Clips '
+                    'where bookid = ?;', (bookid,))]
+        rows.sort(key=lambda row: (row[1], -row[2], row[0]))
+        superseded = _sweep(rows, window)
+        if not superseded:
+            continue
+        for old, keep in superseded.items():
+            _move_notes(conn, old, keep)
+        conn.executemany('delete from Clips where id = ?;',
+                         [(old,) for old in superseded])
+        removed += len(superseded)
+    return removed
+
+
+def dedupe_notes(conn, bookids, window):
+    """合并 bookids 中各书籍的重复笔记，返回删除的行数。
+    一条笔记可能关联多个标注（多行），同一 md5 的行一起保留或删除。"""
+    removed = 0
+    for bookid in bookids:
+        latest = {}
+        old = []
+        for md5, pos, time in conn.execute(
+                'select md5, pos, time from Notes where bookid = ? '
+                'group by md5 order by pos, time, min(id);', (bookid,)):
+            seconds = _seconds(time)
+            prev = latest.get(pos)
+            if prev is not None and seconds is not None and \
+                    prev[1] is not None and seconds - prev[1] <= window:
+                old.append((prev[0],))
+            latest[pos] = (md5, seconds)
+        if old:
+            cur = conn.executemany('delete from Notes where bookid = ? '
+                                   'and md5 = ?;',
+                                   [(bookid,) + md5 for md5 in old])
+            removed += cur.rowcount
+    return removed
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+export
+------
+JSON API 和整库导出用到的查询。
+标注、笔记、书签统一成同样的列（COLUMNS），可以按类型、时间范围和书籍筛选；
+导出时直接迭代 SQLite 游标，按批产出 NDJSON 或 CSV 文本，内存占用与结果大小无关。
+"""
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+COLUMNS = ('type', 'id', 'bookid', 'title', 'author', 'pos', 'startpos',
+           'endpos', 'time', 'content', 'clipid')
+# 每种类型对应的查询，列与 COLUMNS 一致
+_SELECTS = {
+    'clip': "select 'clip', c.id, c.bookid, b.title, b.author, c.pos, "
+            "c.startpos, c.endpos, c.time, c.content, null "
+            "from Clips as c join Books as b on b.id = c.bookid",
+    'note': "select 'note', c.id, c.bookid, b.title, b.author, c.pos, "
+            "null, null, c.time, c.content, c.clipid "
+            "from Notes as c join Books as b on b.id = c.bookid",
+    'mark': "select 'mark', c.id, c.bookid, b.title, b.author, c.pos, "
+            "c.startpos, c.endpos, c.time, null, null "
+            "from Marks as c join Books as b on b.id = c.bookid",
+}
+TYPES = tuple(_SELECTS)
+# 每次从游标读取、产出的行数
+BATCH_SIZE = 1000
+
+
+def _parse_time(value, name):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt), fmt
+        except ValueError:
+            continue
+    raise ValueError('{}: expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS, '
+                     'got {!r}'.format(name, value))
+
+
+def parse_filters(args):
+    """从请求参数中读取筛选条件，参数不合法时抛出 ValueError。
+    type: clip/note/mark，可用逗号分隔或重复；
+    since/until: 日期或时间，都包含在内（until 为日期时包含当天）；
+    book: 书籍id。
+    只导出某个用户的数据时由调用方加上 filters['user']。
+    """
+    types = [t for value in args.getlist('type') for t in value.split(',')
+             if t] or list(TYPES)
+    for t in types:
+        if t not in _SELECTS:
+            raise ValueError('type: expected one of {}, got {!r}'.format(
+                ', '.join(TYPES), t))
+    filters = {'types': sorted(set(types), key=TYPES.index)}
+    since = args.get('since')
+    if since:
+        filters['since'] = _parse_time(since, 'since')[0] \
+            .strftime('%Y-%m-%d %H:%M:%S')
+    until = args.get('until')
+    if until:
+        # 转换为不包含在内的上界
+        until, fmt = _parse_time(until, 'until')
+        until += timedelta(days=1) if fmt == '%Y-%m-%d' else \
+            timedelta(seconds=1)
+        filters['before'] = until.strftime('%Y-%m-%d %H:%M:%S')
+    book = args.get('book')
+    if book is not None:
+        try:
+            filters['book'] = int(book)
+        except ValueError:
+            raise ValueError('book: expected an integer id, got {!r}'.format(
+                book))
+    return filters
+
+
+def _query(filters):
+    """按筛选条件拼出 union all 查询。各类型依次输出，每种类型内按id排序；
+    除了按书籍筛选（只排序一本书的记录）之外，都按id顺序扫描表，不需要排序。"""
+    where, params = [], []
+    if 'since' in filters:
+        where.append('c.time >= ?')
+        params.append(filters['since'])
+    if 'before' in filters:
+        where.append('c.time < ?')
+        params.append(filters['before'])
+    if 'book' in filters:
+        where.append('c.bookid = ?')
+        params.append(filters['book'])
+    if 'user' in filters:
+        # 一元加号使 SQLite 不用 (user_id, md5) 索引，按 id 顺序扫描表，
+        # 不需要在内存中（temp_store）排序整个结果，仍然可以边查询边输出
+        where.append('+c.user_id = ?')
+        params.append(filters['user'])
+    where = ' where ' + ' and '.join(where) if where else ''
+    # union all 的各部分不能带 order by，所以各自包在子查询中
+    selects = ['select * from ({}{} order by c.id)'.format(_SELECTS[t], where)
+               for t in filters['types']]
+    return ' union all '.join(selects) + ';', params * len(selects)
+
+
+def iter_rows(conn, filters):
+    """按批产出满足条件的行（元组）的列表。"""
+    if not conn.execute("select 1 from sqlite_master "
+                        "where name = 'Books';").fetchone():
+        # 还没有上传过文件
+        return
+    sql, params = _query(filters)
+    cur = conn.cursor()
+    # 元组比 sqlite3.Row 快，列名即 COLUMNS
+    cur.row_factory = None
+    cur.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def records(conn, filters):
+    """返回满足条件的所有记录（字典）的列表，用于单本书籍。"""
+    return [dict(zip(COLUMNS, row))
+            for rows in iter_rows(conn, filters) for row in rows]
+
+
+def iter_ndjson(conn, filters):
+    """逐批产出 NDJSON 文本，每行一条记录。"""
+    dumps = json.JSONEncoder(ensure_ascii=False).encode
+    for rows in iter_rows(conn, filters):
+        yield ''.join(dumps(dict(zip(COLUMNS, row))) + '\n' for row in rows)
+
+
+def iter_csv(conn, filters):
+    """逐批产出 CSV 文本，第一行为列名。"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for rows in iter_rows(conn, filters):
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        # 没有任何记录时只输出列名
+        yield buf.getvalue()
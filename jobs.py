@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+jobs
+----
+后台任务：解析上传文件、获取封面等耗时操作作为任务存入 Jobs 表，
+由进程内的线程池执行，请求提交任务后立即返回，页面通过 /api/jobs/<id> 查询进度。
+应用重启后，尚未完成的任务会重新执行，所以任务本身需要可以重复执行。
+多个进程（例如 gunicorn 的多个 worker）可以共用同一个 Jobs 表：任务由
+`update ... where status = 'queued'` 原子地认领，只有认领成功的进程执行；
+运行中的任务记录执行者（主机名:pid:队列），执行者定期更新心跳，
+进程启动时只把执行者已经退出、或心跳超时的任务重新排队。
+init_app(app) 为每个 app 建立单独的队列，保存在 app.extensions['clindle_jobs']，
+模块级的 JobQueue 只保存注册的处理函数，在应用上下文中调用时使用当前 app 的队列，
+同一进程中的多个 app（例如测试）互不影响。
+"""
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from flask import current_app, has_app_context
+
+from db import get_pool
+
+# 任务状态
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# 本进程中所有队列的标识，同一进程中可以有多个队列（例如多个app）
+_queues = set()
+
+
+def _per_app(method):
+    """在应用上下文中调用时，改为调用当前 app 的队列的同名方法。"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return method(self._queue(), *args, **kwargs)
+    return wrapper
+
+
+class JobQueue(object):
+    def __init__(self, database=None, workers=2, heartbeat=10, stale=60):
+        self.database = database
+        self.workers = workers
+        # 每 heartbeat 秒更新一次运行中任务的心跳，超过 stale 秒没有更新视为中断
+        self.heartbeat, self.stale = heartbeat, stale
+        self.app = None
+        self._handlers = {}
+        self._pool = None
+        self._lock = threading.Lock()
+        # 运行中任务的进度只保存在内存中：入库时写事务会锁住数据库，
+        # 不能在同一时间把进度写入 Jobs 表。
+        self._progress = {}
+        # 本进程正在执行的任务
+        self._running = set()
+        self._created = False
+        self._token = secrets.token_hex(4)
+        _queues.add(self._token)
+
+    @property
+    def owner(self):
+        """执行者标识：主机名:pid:队列。在使用时计算，fork 之后的子进程不同。"""
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                 self._token)
+
+    def init_app(self, app):
+        """为 app 建立使用其配置（DATABASE、JOB_WORKERS 等）的队列并返回，
+        任务在 app 的应用上下文中执行。本对象不变，注册的处理函数由各 app 共用。
+        """
+        queue = JobQueue(app.config['DATABASE'], app.config['JOB_WORKERS'],
+                         app.config['JOB_HEARTBEAT'], app.config['JOB_STALE'])
+        queue.app = app
+        queue._handlers = self._handlers
+        app.extensions['clindle_jobs'] = queue
+        return queue
+
+    def _queue(self):
+        """当前 app 的队列；不在应用上下文中或 app 没有队列时为本对象。"""
+        if self.app is None and has_app_context():
+            return current_app.extensions.get('clindle_jobs', self)
+        return self
+
+    @contextmanager
+    def _connect(self):
+        with get_pool(self.database).connection() as conn:
+            if not self._created:
+                conn.execute(
+                    'create table if not exists Jobs ('
+                    'id integer primary key autoincrement, '
+                    'kind text not null, args text not null, '
+                    'status text not null, done integer not null default 0, '
+                    'total integer, result text, '
+                    'created real not null, updated real not null, '
+                    'owner text, heartbeat real);')
+                columns = {row[1] for row in
+                           conn.execute('pragma table_info(Jobs);')}
+                # 之前建立的表没有这两列
+                for column in ('owner text', 'heartbeat real'):
+                    if column.split()[0] not in columns:
+                        conn.execute(
+                            'alter table Jobs add column {};'.format(column))
+                # busy() 在每次请求书籍列表时调用
+                conn.execute('create index if not exists Jobs_status '
+                             'on Jobs(status);')
+                conn.commit()
+                self._created = True
+            yield conn
+
+    def register(self, kind):
+        """装饰器，注册 kind 类任务的处理函数 handler(args, progress)。
+        progress(done, total=None) 用于报告进度；
+        handler 的返回值作为任务结果，抛出异常则任务失败。
+        """
+        def decorator(handler):
+            self._handlers[kind] = handler
+            return handler
+        return decorator
+
+    def _abandoned(self, owner, heartbeat, now):
+        """运行中的任务的执行者是否已经不在了。"""
+        if owner is None or heartbeat is None:
+            # 之前的版本没有记录执行者
+            return True
+        if heartbeat < now - self.stale:
+            return True
+        host, pid, token = (['', ''] + owner.split(':'))[-3:]
+        if host != socket.gethostname():
+            return False
+        if pid == str(os.getpid()):
+            # 同一pid但不是本进程中的队列：之前使用同一pid的进程（例如容器重启）
+            return token not in _queues
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            pass
+        return False
+
+    @_per_app
+    def start(self):
+        """启动线程池，并重新提交尚未完成的任务：排队中的，以及执行者已经退出的。
+        可以重复调用。"""
+        with self._lock:
+            if self._pool is not None:
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            threading.Thread(target=self._beat, daemon=True).start()
+        now = time.time()
+        with self._connect() as conn:
+            for job_id, owner, heartbeat in conn.execute(
+                    'select id, owner, heartbeat from Jobs '
+                    'where status = ?;', (RUNNING,)).fetchall():
+                if self._abandoned(owner, heartbeat, now):
+                    conn.execute('update Jobs set status = ?, owner = null '
+                                 'where id = ? and status = ? and owner is ?;',
+                                 (QUEUED, job_id, RUNNING, owner))
+            conn.commit()
+            job_ids = [row[0] for row in conn.execute(
+                'select id from Jobs where status = ? order by id;',
+                (QUEUED,))]
+        for job_id in job_ids:
+            self._pool.submit(self._execute, job_id)
+
+    @_per_app
+    def submit(self, kind, **args):
+        """提交任务，返回任务id。"""
+        if kind not in self._handlers:
+            raise ValueError('Unknown job kind: {}'.format(kind))
+        self.start()
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                'insert into Jobs(kind, args, status, created, updated) '
+                'values(?, ?, ?, ?, ?);',
+                (kind, json.dumps(args), QUEUED, now, now))
+            conn.commit()
+            job_id = cur.lastrowid
+        self._pool.submit(self._execute, job_id)
+        return job_id
+
+    @staticmethod
+    def _match(args, match):
+        return all(args.get(k) == v for k, v in match.items())
+
+    @_per_app
+    def busy(self, **match):
+        """是否有排队中或运行中的任务，包括其他进程提交的；
+        给出 match 时只考虑参数与之相同的任务，例如 busy(user='a')。"""
+        # 心跳超时的任务的执行者已经中断，不算在内
+        with self._connect() as conn:
+            return any(self._match(json.loads(row[0]), match)
+                       for row in conn.execute(
+                           'select args from Jobs where status = ? or '
+                           '(status = ? and heartbeat >= ?);',
+                           (QUEUED, RUNNING, time.time() - self.stale)))
+
+    @_per_app
+    def get(self, job_id):
+        """返回任务状态字典，任务不存在时返回None。"""
+        with self._connect() as conn:
+            row = conn.execute('select * from Jobs where id = ?;',
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['args'] = json.loads(job['args'])
+        if job['status'] == RUNNING and job_id in self._progress:
+            job['done'], job['total'] = self._progress[job_id]
+        return job
+
+    @_per_app
+    def active(self, **match):
+        """返回排队中和运行中的任务，match 同 busy()。"""
+        with self._connect() as conn:
+            job_ids = [row[0] for row in conn.execute(
+                'select id, args from Jobs where status in (?, ?) '
+                'order by id;', (QUEUED, RUNNING))
+                if self._match(json.loads(row[1]), match)]
+        return [self.get(job_id) for job_id in job_ids]
+
+    def _update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'update Jobs set {} where id = ?;'.format(
+                    ', '.join(k + ' = ?' for k in fields)),
+                tuple(fields.values()) + (job_id,))
+            conn.commit()
+
+    def _beat(self):
+        """心跳线程：更新本进程运行中的任务的心跳。"""
+        while True:
+            time.sleep(self.heartbeat)
+            if not self._running:
+                continue
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        'update Jobs set heartbeat = ? where owner = ? '
+                        'and status = ?;', (time.time(), self.owner, RUNNING))
+                    conn.commit()
+            except sqlite3.OperationalError:
+                # 数据库被长时间锁住时下次再更新
+                pass
+
+    def _claim(self, job_id):
+        """认领排队中的任务，返回是否成功；其他进程已经认领时返回False。"""
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                'update Jobs set status = ?, owner = ?, heartbeat = ?, '
+                'updated = ? where id = ? and status = ?;',
+                (RUNNING, self.owner, now, now, job_id, QUEUED))
+            conn.commit()
+        return cur.rowcount == 1
+
+    def _execute(self, job_id):
+        job = self.get(job_id)
+        if job is None or not self._claim(job_id):
+            return
+        self._running.add(job_id)
+        self._progress[job_id] = (0, None)
+
+        def progress(done, total=None):
+            self._progress[job_id] = (done, total)
+
+        context = self.app.app_context() if self.app is not None else \
+            nullcontext()
+        try:
+            with context:
+                result = self._handlers[job['kind']](job['args'], progress)
+        except Exception as e:
+            status, result = FAILED, str(e)
+        else:
+            status = DONE
+        self._running.discard(job_id)
+        done, total = self._progress.pop(job_id, (0, None))
+        self._update(job_id, status=status, done=done, total=total,
+                     result=None if result is None else str(result))
+
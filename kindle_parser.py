@@ -7,28 +7,109 @@ parser
 """
 import hashlib
 import json
+import multiprocessing
 import os
 import re
-from collections import defaultdict
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-from config import JSONFILE_FOLDER, UPLOAD_FOLDER
+from clipping import Clip, dump_json
+from config import (JSONFILE_FOLDER, PARALLEL_PARSE_THRESHOLD, PARSE_WORKERS,
+                    UPLOAD_FOLDER)
+from metrics import PARSE_SECONDS, timed_iter
+
+try:
+    # CPython 自带的md5实现，对短字符串比 OpenSSL 版本快，结果相同
+    from _md5 import md5 as _md5
+except ImportError:
+    from hashlib import md5 as _md5
+
+# 所有正则只在导入时编译一次。
+# 快速路径：从记录开头锚定、一次匹配出全部字段的写法，覆盖 Kindle 生成的
+# 标注、笔记和书签，以及三种位置写法：
+# '位置 #1-2 '、'第 1 页（位置 #1-2）'、'第 1-2 页'
+_RECORD_PTN = re.compile(
+    r'(?!==========\n)(.+)\n'
+    r'(- 您在(?:位置 (#([0-9]+)(?:-([0-9]+))?) ?'
+    r'|(第 ([0-9]+)(?:-([0-9]+))? \S)(?:（位置 (#([0-9]+)(?:-([0-9]+))?)）)?)'
+    r'的(\S+) \| 添加于 (([^:|\n]+):([0-9]{2}:[0-9]{2})))\n'
+    r'\n(?:(?!==========\n)(.+)\n|\n)==========\n')
+# 原来的写法，快速路径不匹配时使用，保证结果与之前完全一致
+_HEADER_PTN = re.compile(r'.*您在(.{1}\s[0-9-]+\s.{1})?.*?(#[0-9-]+)?.?'
+                         r'的(.*)?\s\|\s添加于\s(.*)$')
+_TIME_PTN = re.compile(r'(\d*)年(\d*)月(\d*)日.*(.{1})午(\d*):(\d*):(\d*)')
+_HOUR_PTN = re.compile(r'(\d+)年(\d+)月(\d+)日星期\S (\S)午(\d+)$')
+_POS_PTN = re.compile(r'(?:.*#(\d+)-?(\d+)?)|(?:第(\d+)-?(\d+)?)')
+# 分隔行
+_SPLIT_PTN = re.compile(r'^==========\n', re.M)
+_SPLIT_BYTES_PTN = re.compile(rb'^==========\r?\n', re.M)
+
+
+@lru_cache(maxsize=8192)
+def _format_hour(head):
+    """'2017年1月1日星期日 下午3' to 'YYYY-MM-DD HH'，不符合格式时返回None。
+    同一小时内的标注通常有很多条，所以缓存结果。
+    """
+    attrs = _HOUR_PTN.match(head)
+    if not attrs:
+        return None
+    year, month, day, noon, hour = attrs.groups()
+    if noon == '下' and hour != '12':
+        hour = str(int(hour) + 12)
+    return '{}-{:0>2}-{:0>2} {:0>2}'.format(year, month, day, hour)
+
+
+def _plain(text):
+    """text 中除换行外没有引号、反斜杠和不可打印字符时返回True。
+    这时每一行的 repr 就是在两边加上引号，不需要逐个字符转义。
+    """
+    return "'" not in text and '\\' not in text and \
+        text.replace('\n', '').isprintable()
+
+
+def _clip_id(clip):
+    """返回 md5(str(clip)) 的16字节摘要，十六进制值即每条记录的id。"""
+    if _plain('\n'.join(clip)):
+        text = "['" + "', '".join(clip) + "']"
+    else:
+        text = str(clip)
+    return _md5(text.encode('utf-8')).digest()
 
 
 # 定义可以对文本进行解析的类
 class ClipsParser(object):
-    def __init__(self, filename):
+    def __init__(self, filename, checkpoint=None, workers=None,
+                 threshold=None):
+        """checkpoint: 上次解析同一来源文件后得到的 (offset, prefix_md5)，
+        offset 为最后一个完整记录（分隔行）之后的字节偏移，prefix_md5 为
+        文件前 offset 个字节的md5。解析结束后 self.checkpoint 更新为本次的值。
+        workers: 需要解析的内容超过 threshold 字节时使用的进程数，
+        默认为 PARSE_WORKERS，都为None时使用全部CPU。
+        threshold: 默认为 PARALLEL_PARSE_THRESHOLD。
+        """
         self.__full_filename = os.path.join(UPLOAD_FOLDER, filename)
         self.__filename = filename
+        self.checkpoint = checkpoint
+        self.workers = workers or PARSE_WORKERS or os.cpu_count() or 1
+        self.threshold = PARALLEL_PARSE_THRESHOLD if threshold is None \
+            else threshold
+        # 本次解析是否从 checkpoint 处继续
+        self.resumed = False
 
-    __SPLIT_LINE = '==========\n'
     __USELESS_PREFIX = '\ufeff'
+    __HASH_CHUNK = 1024 * 1024
+    # 每次读取的块大小，内存中最多保留一个块
+    __READ_CHUNK = 1024 * 1024
+    # 多进程解析时，每个子进程每次解析的字节数
+    __RANGE_SIZE = 8 * 1024 * 1024
 
     def _format_time(self, timestr):
         """format original kindle date&time:
         '2017年1月1日星期日 下午3:23:07' to 'YYYY-MM-DD HH:MM:SS'.
         """
-        patn = re.compile(r'(\d*)年(\d*)月(\d*)日.*(.{1})午(\d*):(\d*):(\d*)')
-        tiktok = patn.match(timestr)
+        tiktok = _TIME_PTN.match(timestr)
         year = tiktok.group(1)
         timelist = [year] + \
             ['{:0>2}'.format(tiktok.group(i)) for i in (2, 3, 5, 6, 7)]
@@ -46,8 +127,7 @@ class ClipsParser(object):
         3: both 1 and 2;
         4: '第 1-2 页'|'第 1 页';
         """
-        patn = re.compile(r'(?:.*#(\d+)-?(\d+)?)|(?:第(\d+)-?(\d+)?)')
-        posptn = patn.match(pos.replace(' ', ''))
+        posptn = _POS_PTN.match(pos.replace(' ', ''))
         if posptn.group(1):
             s_pos = posptn.group(1)
             e_pos = posptn.group(2)
@@ -56,81 +136,302 @@ class ClipsParser(object):
             e_pos = posptn.group(4)
         return (int(s_pos), int(e_pos)) if e_pos else (int(s_pos), int(s_pos))
 
-    def _getclips(self):
-        """读取'My Clippings.txt'文件，解析并将‘标注’存入列表中。
+    def _resume(self, f):
+        """校验 checkpoint：文件前 offset 个字节的md5不变，说明文件只是被追加，
+        直接跳到 offset 处；否则（文件被改写、换了设备等）从头解析。
+        返回 (offset, 已包含前缀内容的md5对象)。
+        """
+        prefix = hashlib.md5()
+        self.resumed = False
+        if not self.checkpoint:
+            return 0, prefix
+        offset, digest = self.checkpoint
+        if os.fstat(f.fileno()).st_size >= offset:
+            remain = offset
+            while remain:
+                chunk = f.read(min(remain, self.__HASH_CHUNK))
+                if not chunk:
+                    break
+                prefix.update(chunk)
+                remain -= len(chunk)
+            if not remain and prefix.hexdigest() == digest:
+                self.resumed = True
+                return offset, prefix
+        self.checkpoint = None
+        f.seek(0)
+        return 0, hashlib.md5()
+
+    def _last_split(self, buf, start=0, eof=False):
+        """返回 buf[start:] 中最后一个分隔行结束处的偏移，没有时返回0。
+        eof 为 True 时，末尾没有换行符的分隔行也算在内。
+        """
+        if eof and buf.rsplit(b'\n', 1)[-1].rstrip(b'\r') == b'==========':
+            return len(buf)
+        end = len(buf)
+        while True:
+            pos = buf.rfind(b'==========', start, end)
+            if pos < 0:
+                return 0
+            eol = buf[pos + 10:pos + 12]
+            if pos == 0 or buf[pos - 1] == 0x0a:
+                if eol[:1] == b'\n':
+                    return pos + 11
+                if eol == b'\r\n':
+                    return pos + 12
+            end = pos
+
+    def _next_split(self, f, pos):
+        """返回文件中 pos 及之后第一个分隔行结束处的偏移，没有时返回文件大小。"""
+        # 从 pos 的前一个字节开始读，以判断分隔行是否在行首
+        base = max(pos - 1, 0)
+        f.seek(base)
+        skip = 1 if pos else 0
+        buf = b''
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                return base + len(buf)
+            buf += data
+            split = _SPLIT_BYTES_PTN.search(buf, skip)
+            if split:
+                return base + split.end()
+            # 保留末尾的一行，分隔行可能被截断在两次读取之间
+            keep = min(len(buf), 13)
+            base += len(buf) - keep
+            buf, skip = buf[len(buf) - keep:], 1
+
+    def fingerprint(self):
+        """来源文件（设备）的标识：文件中第一条记录的md5。
+        同一台设备的文件只会被追加，第一条记录不变；每台 Kindle 的文件名都是
+        'My Clippings.txt'，不能用文件名区分设备。
+        """
+        with open(self.__full_filename, 'rb') as f:
+            end = self._next_split(f, 0)
+            f.seek(0)
+            return hashlib.md5(f.read(end)).hexdigest()
+
+    def _decode(self, chunk):
+        text = chunk.decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+        # 文件末尾的分隔行可能没有换行符
+        return text if text.endswith('\n') else text + '\n'
+
+    def _iter_chunks(self, f, offset, prefix):
+        """从 offset 处按块读取'My Clippings.txt'文件，每块在最后一个分隔行
+        之后截断，解码后产出，内存中最多只保留一块内容，与文件大小无关。
+        Read the file in chunks cut right after a separator line.
         """
-        # 因为 My Clippings.txt 不是unicode编码，打开时需要设置编码方式
-        with open(self.__full_filename, 'r', encoding='utf-8') as f:
-            clips = f.read()
-        return [c for c in clips.split(self.__SPLIT_LINE) if c]
+        buf = b''
+        while True:
+            data = f.read(self.__READ_CHUNK)
+            # 只在新读入的内容中查找分隔行（留出一行的余量）
+            start = max(0, len(buf) - 12)
+            buf += data
+            cut = self._last_split(buf, start, eof=not data)
+            if not cut:
+                if not data:
+                    break
+                continue
+            chunk, buf = buf[:cut], buf[cut:]
+            yield self._decode(chunk)
+            # 只在完整记录之后更新 checkpoint
+            offset += cut
+            prefix.update(chunk)
+            self.checkpoint = (offset, prefix.hexdigest())
+        # 文件末尾可能没有分隔行，这条记录下次还会被解析（md5相同，入库时会被忽略）
+        if buf:
+            yield self._decode(buf)
+
+    def _iter_ranges(self, f, offset, prefix, size):
+        """多进程解析：把 offset 之后的内容按分隔行切成若干段，由进程池解析，
+        按在文件中的顺序产出每一段的解析结果（_parsechunk() 的返回值），
+        所以结果与单进程解析完全相同。
+        """
+        bounds = [offset]
+        while bounds[-1] < size:
+            pos = bounds[-1] + self.__RANGE_SIZE
+            bounds.append(self._next_split(f, pos) if pos < size else size)
+        # 用 spawn 启动子进程，不复制web应用中的线程和数据库连接
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+            # 最多提前解析 2 * workers 段，入库较慢时不会占用过多内存
+            pending = deque()
+            for start, end in zip(bounds, bounds[1:]):
+                pending.append((start, end, pool.submit(
+                    _parse_range, self.__full_filename, start, end)))
+                if len(pending) >= 2 * self.workers:
+                    yield from self._collect(f, prefix, size,
+                                             *pending.popleft())
+            while pending:
+                yield from self._collect(f, prefix, size, *pending.popleft())
+
+    def _collect(self, f, prefix, size, start, end, future):
+        """产出一段的解析结果，然后更新 checkpoint。"""
+        f.seek(start)
+        chunk = f.read(end - start)
+        # 最后一段可能以没有分隔行的记录结尾
+        cut = self._last_split(chunk, eof=True) if end == size else len(chunk)
+        yield future.result()
+        if cut:
+            prefix.update(chunk[:cut])
+            self.checkpoint = (start + cut, prefix.hexdigest())
+
+    def _iter_parsed(self):
+        """逐段产出解析结果。需要解析的内容超过 threshold 字节时
+        使用多进程，否则在当前进程中流式解析。
+        """
+        # 以二进制方式读取以便记录字节偏移
+        with open(self.__full_filename, 'rb') as f:
+            offset, prefix = self._resume(f)
+            size = os.fstat(f.fileno()).st_size
+            if self.workers > 1 and size - offset >= self.threshold:
+                yield from self._iter_ranges(f, offset, prefix, size)
+                return
+            for text in self._iter_chunks(f, offset, prefix):
+                yield self._parsechunk(text)
+
+    def _parseclip(self, clip):
+        """解析单条记录（非空行的列表），返回 (bookname, Clip)。
+        """
+        # clip对应的书籍名称，同一本书的记录共用一个字符串
+        bookname = sys.intern(clip[0].lstrip(self.__USELESS_PREFIX).strip())
+        # 使用md5值作为每个clip的独特id
+        digest = _clip_id(clip)
+        # 获取clip的类型、标注位置和标注时间
+        attrs = _HEADER_PTN.match(clip[1])
+        # 由于“标注位置”的具体形式有三种，所以这里需要进行判断
+        if attrs.group(1):
+            if attrs.group(2):
+                pos = attrs.group(1) + '(' + attrs.group(2) + ')'
+            else:
+                pos = attrs.group(1)
+            clip_type = attrs.group(3)
+            time = attrs.group(4)
+        else:
+            pos = attrs.group(2)
+            clip_type = attrs.group(3)
+            time = attrs.group(4)
+        # 标注、笔记对应的具体内容
+        content = clip[2] if len(clip) > 2 else None
+
+        start_pos, end_pos = self._format_pos(pos)
+        return bookname, Clip(digest, clip_type, pos, start_pos, end_pos,
+                              self._format_time(time), content)
+
+    def _parsechunk(self, text):
+        """解析以分隔行结尾的一段文本，返回 (bookname, Clip) 的列表。
+        标准格式的记录由 _RECORD_PTN 一次匹配出全部字段，不需要回溯；
+        其余的记录（多行内容、其他位置写法等）切分成行后交给 _parseclip。
+        """
+        clips = []
+        match = _RECORD_PTN.match
+        intern = sys.intern
+        useless = self.__USELESS_PREFIX
+        # 整段检查一次，就不必对每条记录调用 str(clip)
+        plain = _plain(text)
+        offset, size = 0, len(text)
+        while offset < size:
+            attrs = match(text, offset)
+            if attrs is None:
+                split = _SPLIT_PTN.search(text, offset)
+                clip = text[offset:split.start() if split else size]
+                clip = list(filter(None, clip.split('\n')))
+                if clip:
+                    clips.append(self._parseclip(clip))
+                offset = split.end() if split else size
+                continue
+            offset = attrs.end()
+            (title, header, at_pos, at_start, at_end, page, page_start, page_end,
+             page_pos, pp_start, pp_end, clip_type, time, head, rest,
+             content) = attrs.groups()
+            if at_pos:
+                pos, start_pos, end_pos = at_pos, at_start, at_end
+            elif page_pos:
+                pos = page + '(' + page_pos + ')'
+                start_pos, end_pos = pp_start, pp_end
+            else:
+                pos, start_pos, end_pos = page, page_start, page_end
+            start_pos = int(start_pos)
+            hour = _format_hour(head)
+            if not plain:
+                digest = _clip_id([title, header, content] if content else
+                                  [title, header])
+            elif content:
+                digest = _md5("['{}', '{}', '{}']".format(
+                    title, header, content).encode('utf-8')).digest()
+            else:
+                digest = _md5("['{}', '{}']".format(
+                    title, header).encode('utf-8')).digest()
+            clips.append((
+                intern(title.lstrip(useless).strip()),
+                Clip(digest, clip_type, pos, start_pos,
+                     int(end_pos) if end_pos else start_pos,
+                     hour + ':' + rest if hour else self._format_time(time),
+                     content)))
+        return clips
+
+    def iter_clips(self, backup=False):
+        """流式解析：逐条产出 (bookname, index, Clip)，内存占用与文件大小无关。
+        index 为十六进制的md5，Clip 可以像之前的字典一样按键读取，见 clipping.py。
+        backup 为 True 时，同时将每条记录以 JSON Lines 格式写入备份文件。
+        Streaming mode: yield one parsed clip at a time, so that save2db and
+        the json backup can consume it in a pipeline.
+        """
+        # 只统计解析本身的耗时，不包括使用方处理每条记录的时间
+        parsed = timed_iter(self._iter_parsed(), PARSE_SECONDS)
+        if not backup:
+            for clips in parsed:
+                for bookname, clip in clips:
+                    yield bookname, clip.index, clip
+            return
+        jsonname = self.__filename.split('.')[0] + '.jsonl'
+        jsonfile = os.path.join(JSONFILE_FOLDER, jsonname)
+        with open(jsonfile, 'w') as f:
+            for clips in parsed:
+                clips = [(bookname, clip.index, clip)
+                         for bookname, clip in clips]
+                f.writelines(json.dumps([bookname, index, clip.as_dict()]) +
+                             '\n' for bookname, index, clip in clips)
+                yield from clips
 
     def _parseclips(self, clips):
         """将所有的标注解析至一个字典中，字典schema如下：
         {
             bookname: {
-                index: {
-                    'type': value,
-                    'pos': value,
-                    'start_pos': value,
-                    'end_pos': value,
-                    'time': value,
-                    'content': value
-                },
+                digest: Clip(type, pos, start_pos, end_pos, time, content),
                 ...
             },
             ...
         }
+        digest 为16字节的md5。clipping.as_dicts() 可以转换为之前以十六进制md5
+        为键、以字典为值的格式。
+        clips 为 iter_clips() 产出的 (bookname, index, Clip) 序列。
         """
         book_clips = defaultdict(dict)
-        for num, clip in enumerate(clips):
-            clip = [n for n in clip.split('\n') if n]
-            # clip对应的书籍名称
-            bookname = clip[0].lstrip(self.__USELESS_PREFIX).strip()
-            # 使用md5值作为每个clip的独特id
-            index_md5 = hashlib.md5()
-            index_md5.update(str(clip).encode('utf-8'))
-            index = index_md5.hexdigest()
-            # 获取clip的类型、标注位置和标注时间
-            attrs = re.match(r'.*您在(.{1}\s[0-9-]+\s.{1})?.*?(#[0-9-]+)?.?'
-                             '的(.*)?\s\|\s添加于\s(.*)$', clip[1])
-            # 由于“标注位置”的具体形式有三种，所以这里需要进行判断
-            if attrs.group(1):
-                if attrs.group(2):
-                    pos = attrs.group(1) + '(' + attrs.group(2) + ')'
-                else:
-                    pos = attrs.group(1)
-                clip_type = attrs.group(3)
-                time = attrs.group(4)
-            else:
-                pos = attrs.group(2)
-                clip_type = attrs.group(3)
-                time = attrs.group(4)
-            # 标注、笔记对应的具体内容
-            try:
-                content = clip[2]
-            except:
-                content = None
-
-            start_pos, end_pos = self._format_pos(pos)
-            book_clip = {'type': clip_type, 'pos': pos,
-                         'start_pos': start_pos, 'end_pos': end_pos,
-                         'time': self._format_time(time), 'content': content}
-
-            book_clips[bookname].update({index: book_clip})
-
+        for bookname, _, clip in clips:
+            book_clips[bookname][clip.digest] = clip
         return book_clips
 
     def parse(self):
-        clips = self._getclips()
-        book_clips = self._parseclips(clips)
+        book_clips = self._parseclips(self.iter_clips())
         # 保存json格式文件作为备份。
         jsonname = self.__filename.split('.')[0] + '.json'
         jsonfile = os.path.join(JSONFILE_FOLDER, jsonname)
         with open(jsonfile, 'w') as f:
-            json.dump(book_clips, f)
+            dump_json(book_clips, f)
         return book_clips
 
 
+def _parse_range(filename, start, end):
+    """在子进程中执行：解析文件中 [start, end) 之间的内容。"""
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    parser = ClipsParser(filename)
+    return parser._parsechunk(parser._decode(chunk))
+
+
 # Testing
 if __name__ == '__main__':
     filename = '20170609_010107_My_Clippings.txt'
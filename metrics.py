@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+metrics
+-------
+耗时统计：解析、入库的各个阶段、全文索引、请求中的每条SQL、模板渲染和获取封面。
+直方图和计数器保存在进程内，由 /metrics 以 Prometheus 文本格式输出。
+
+请求中的SQL用 sqlite3 的 trace callback 计时：回调在每条语句开始执行时调用，
+一条语句的耗时记为从它开始到下一条语句开始（或开始渲染模板、请求结束）之间的时间，
+包括读取结果行的时间。每个请求的计时保存在各自的 RequestTimer 中。
+"""
+import threading
+import time
+from collections import defaultdict
+
+# 秒
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Counter(object):
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(
+                    self.name, _labels(self.labels, key), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各区间的计数..., 总数, 总和]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """返回一个计时器，with 语句结束时记录耗时。"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} histogram'.format(self.name)]
+        names = self.labels + ('le',)
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                total = 0
+                for bound, count in zip(self.buckets, counts):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, _labels(names, key + (bound,)), total))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(names, key + ('+Inf',)), counts[-2]))
+                lines.append('{}_sum{} {}'.format(
+                    self.name, _labels(self.labels, key), counts[-1]))
+                lines.append('{}_count{} {}'.format(
+                    self.name, _labels(self.labels, key), counts[-2]))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram, self.labels = histogram, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Laps(object):
+    """依次记录连续几个阶段的耗时：每次调用记录从上一次调用（或创建）到现在的时间。
+        lap = Laps(SAVE2DB_SECONDS, 'stage')
+        ...; lap('prepare')
+        ...; lap('commit')
+    """
+    def __init__(self, histogram, label):
+        self.histogram, self.label = histogram, label
+        self.last = time.perf_counter()
+
+    def __call__(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, **{self.label: stage})
+        self.last = now
+
+
+def timed_iter(iterable, histogram, **labels):
+    """透传 iterable，把花在产出上的时间（不包括使用方处理的时间）
+    累计起来，迭代结束时记录一次。"""
+    iterator = iter(iterable)
+    spent = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            histogram.observe(spent + time.perf_counter() - start, **labels)
+            return
+        spent += time.perf_counter() - start
+        yield item
+
+
+def render():
+    """所有指标的 Prometheus 文本格式。"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'clindle_request_seconds', 'Time spent handling a request.',
+    ('endpoint',))
+SQL_SECONDS = Histogram(
+    'clindle_sql_seconds',
+    'Time from the start of an SQL statement in a request to the next '
+    'statement, template rendering or the end of the request.',
+    ('endpoint', 'statement'))
+SLOW_QUERIES = Counter(
+    'clindle_slow_queries_total',
+    'SQL statements slower than SLOW_QUERY_MS.', ('endpoint',))
+TEMPLATE_SECONDS = Histogram(
+    'clindle_template_seconds', 'Time spent rendering a template.',
+    ('template',))
+PARSE_SECONDS = Histogram(
+    'clindle_parse_seconds', 'Time spent parsing one clippings file.')
+SAVE2DB_SECONDS = Histogram(
+    'clindle_save2db_seconds',
+    'Time spent in each stage of save2db, per batch.', ('stage',))
+SEARCH_INDEX_SECONDS = Histogram(
+    'clindle_search_index_seconds',
+    'Time spent adding a batch of clips and notes to the search index.')
+COVER_FETCH_SECONDS = Histogram(
+    'clindle_cover_fetch_seconds', 'Time spent fetching one book cover.',
+    ('result',))
+RESPONSE_CACHE = Counter(
+    'clindle_response_cache_total', 'Response cache lookups.', ('result',))
+
+
+class RequestTimer(object):
+    """一个请求中的计时。trace() 作为连接的 trace callback。
+    slow_ms 不为None时，耗时超过 slow_ms 毫秒的语句交给 log(耗时, sql) 记录。
+    """
+    def __init__(self, endpoint, slow_ms=None, log=None):
+        self.endpoint = endpoint
+        self.slow_ms, self.log = slow_ms, log
+        self.start = time.perf_counter()
+        self.sql_seconds = 0
+        self.statements = 0
+        self.render_seconds = 0
+        self._pending = None
+
+    def trace(self, sql):
+        # 触发器中的语句以注释的形式报告，计入触发它的语句
+        if sql.startswith('--'):
+            return
+        self.mark()
+        self._pending = (time.perf_counter(), sql)
+
+    def mark(self):
+        """结束正在计时的语句。"""
+        if self._pending is None:
+            return
+        start, sql = self._pending
+        self._pending = None
+        seconds = time.perf_counter() - start
+        self.sql_seconds += seconds
+        self.statements += 1
+        statement = sql.lstrip().split(None, 1)[0].lower() if sql.strip() \
+            else ''
+        SQL_SECONDS.observe(seconds, endpoint=self.endpoint,
+                            statement=statement)
+        if self.slow_ms is not None and seconds * 1000 >= self.slow_ms:
+            SLOW_QUERIES.inc(endpoint=self.endpoint)
+            if self.log:
+                self.log(seconds, sql)
+
+    def rendered(self, seconds, template):
+        self.render_seconds += seconds
+        TEMPLATE_SECONDS.observe(seconds, template=template)
+
+    def finish(self):
+        """请求结束时调用，返回总耗时（秒）。"""
+        self.mark()
+        seconds = time.perf_counter() - self.start
+        REQUEST_SECONDS.observe(seconds, endpoint=self.endpoint)
+        return seconds
+
+    def server_timing(self):
+        """Server-Timing 响应头。"""
+        self.mark()
+        return 'sql;dur={:.3f};desc="{} statements", render;dur={:.3f}'.format(
+            self.sql_seconds * 1000, self.statements,
+            self.render_seconds * 1000)
@@ -1,41 +1,128 @@
 -- using sqlite;
-DROP TABLE IF EXISTS Books;
-DROP TABLE IF EXISTS Clips;
-DROP TABLE IF EXISTS Notes;
-DROP TABLE IF EXISTS Marks;
-
-CREATE TABLE Books (
+-- 表结构变化时需要同步修改 utils.SCHEMA_VERSION，旧表会在下次上传时重建。
+-- user_id 为数据所属的用户（单用户时为 ''），见 users.py；
+-- source_id 为记录第一次从哪台设备上传：上传时填写的设备名，
+-- 或设备的文件中第一条记录的md5（见 ClipsParser.fingerprint()）。
+CREATE TABLE IF NOT EXISTS Books (
     id integer primary key autoincrement,
+    user_id text not null default '',
     title text not null,
     author text,
-    cover text
+    cover text,
+    -- 书名的拼音排序键，由 utils.pinyin_key 生成
+    titlekey text not null,
+    -- 标注/笔记/书签数，由下面的触发器维护
+    clipnum integer not null default 0,
+    notenum integer not null default 0,
+    marknum integer not null default 0,
+    UNIQUE(user_id, title)
 );
-CREATE TABLE Clips (
+CREATE TABLE IF NOT EXISTS Clips (
     id integer primary key autoincrement,
+    md5 text not null,
     pos text not null,
     startpos integer not null,
     endpos integer,
     time text not null,
     content text,
     bookid integer not null,
+    user_id text not null default '',
+    source_id text,
+    UNIQUE(user_id, md5),
     FOREIGN KEY(bookid) REFERENCES Books(id)
 );
-CREATE TABLE Notes (
+CREATE TABLE IF NOT EXISTS Notes (
     id integer primary key autoincrement,
+    md5 text not null,
     pos text not null,
     time text not null,
     content text not null,
     bookid integer not null,
     clipid integer not null,
+    user_id text not null default '',
+    source_id text,
+    UNIQUE(md5, clipid),
     FOREIGN KEY(bookid) REFERENCES Books(id),
     FOREIGN KEY(clipid) REFERENCES Clips(id)
-);  
-CREATE TABLE Marks (
+);
+CREATE TABLE IF NOT EXISTS Marks (
     id integer primary key autoincrement,
+    md5 text not null,
     pos text not null,
     startpos integer not null,
     endpos integer,
     time text not null,
     bookid integer not null,
+    user_id text not null default '',
+    source_id text,
+    UNIQUE(user_id, md5),
     FOREIGN KEY(bookid) REFERENCES Books(id)
 );
+-- 每个用户的书籍列表按拼音排序，索引隐含id列，即按 (titlekey, id) 的keyset分页
+CREATE INDEX IF NOT EXISTS Books_user_titlekey ON Books(user_id, titlekey);
+-- 按书籍查询标注/书签/笔记时使用的索引，也用于按 (startpos, id) 的keyset分页
+CREATE INDEX IF NOT EXISTS Clips_book_pos ON Clips(bookid, startpos);
+CREATE INDEX IF NOT EXISTS Marks_book_pos ON Marks(bookid, startpos);
+CREATE INDEX IF NOT EXISTS Notes_book ON Notes(bookid);
+CREATE INDEX IF NOT EXISTS Notes_clip ON Notes(clipid);
+-- 入库时按 md5 检查笔记是否已经存在
+CREATE INDEX IF NOT EXISTS Notes_user_md5 ON Notes(user_id, md5);
+-- 每个用户的每个来源文件（设备）上次解析到的位置，用于只解析新追加的部分
+CREATE TABLE IF NOT EXISTS Sources (
+    user_id text not null default '',
+    source text not null,
+    offset integer not null,
+    md5 text not null,
+    PRIMARY KEY(user_id, source)
+);
+-- 封面缓存，以书名为键；重建数据库时保留。
+-- filename 为空表示没有找到或获取失败，retry 之后（unix时间）才会重试
+CREATE TABLE IF NOT EXISTS Covers (
+    title text primary key,
+    src text,
+    filename text,
+    fails integer not null default 0,
+    retry real not null default 0,
+    updated real not null
+);
+-- 每个用户的数据版本，数据变化时在同一事务中加一，页面缓存以此失效（见 cache.py）；
+-- 重建数据库时保留，modified 保证重建后的版本号也不会与之前的相同
+CREATE TABLE IF NOT EXISTS Generations (
+    user_id text primary key,
+    generation integer not null default 0,
+    modified real not null default 0
+);
+-- 每个用户的汇总，用户的第一本书入库时创建
+CREATE TABLE IF NOT EXISTS Library (
+    user_id text primary key,
+    bookcount integer not null default 0
+);
+
+-- 维护 Books 中的计数和 Library 中的书籍总数
+CREATE TRIGGER IF NOT EXISTS Books_ins AFTER INSERT ON Books BEGIN
+    INSERT OR IGNORE INTO Library(user_id) VALUES (new.user_id);
+    UPDATE Library SET bookcount = bookcount + 1
+    WHERE user_id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS Books_del AFTER DELETE ON Books BEGIN
+    UPDATE Library SET bookcount = bookcount - 1
+    WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS Clips_ins AFTER INSERT ON Clips BEGIN
+    UPDATE Books SET clipnum = clipnum + 1 WHERE id = new.bookid;
+END;
+CREATE TRIGGER IF NOT EXISTS Clips_del AFTER DELETE ON Clips BEGIN
+    UPDATE Books SET clipnum = clipnum - 1 WHERE id = old.bookid;
+END;
+CREATE TRIGGER IF NOT EXISTS Notes_ins AFTER INSERT ON Notes BEGIN
+    UPDATE Books SET notenum = notenum + 1 WHERE id = new.bookid;
+END;
+CREATE TRIGGER IF NOT EXISTS Notes_del AFTER DELETE ON Notes BEGIN
+    UPDATE Books SET notenum = notenum - 1 WHERE id = old.bookid;
+END;
+CREATE TRIGGER IF NOT EXISTS Marks_ins AFTER INSERT ON Marks BEGIN
+    UPDATE Books SET marknum = marknum + 1 WHERE id = new.bookid;
+END;
+CREATE TRIGGER IF NOT EXISTS Marks_del AFTER DELETE ON Marks BEGIN
+    UPDATE Books SET marknum = marknum - 1 WHERE id = old.bookid;
+END;
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+search
+------
+标注和笔记的全文检索。
+SearchIndex 是一个 FTS5 虚拟表，标注以 Clips.id、笔记以 -Notes.id 作为 rowid，
+由触发器在入库（以及删除）时同步更新；批量入库时可以用 deferred_index()
+暂停触发器，改为每批一次性写入索引。
+中文没有空格分词，所以默认使用 trigram 分词器（按三个字符一组建立索引），
+任意三个字及以上的子串都可以走索引。
+中文的词大多只有两个字，所以另有一个 SearchShort 表，rowid 与 SearchIndex 相同，
+索引的是 bigrams() 预先切分好的相邻两个字（以及每段文字的最后一个字）：
+两个字的词直接查这个词，一个字的词用前缀查询 '字*'。
+只有包含标点等非文字字符的短词才退回到对索引内容的 LIKE 扫描。
+切分在SQL函数 bigrams() 中进行，由 db.connect() 注册到每个连接。
+"""
+import re
+import sqlite3
+from contextlib import contextmanager
+
+from markupsafe import Markup, escape
+
+from config import SEARCH_TOKENIZER
+from metrics import SEARCH_INDEX_SECONDS
+
+# highlight() 使用的临时标记，转义HTML之后再替换为<mark>
+_MARK_L, _MARK_R = '\x02', '\x03'
+# trigram 分词器能够检索的最短长度
+_MIN_TERM = 3
+# 连续的文字（字母、数字和汉字等），与 unicode61 分词器的划分一致
+_WORD_PTN = re.compile(r'[^\W_]+')
+
+
+def bigrams(text):
+    """'我们的书，好' -> '我们 们的 的书 书 好'：每段连续文字中相邻的两个字，
+    再加上最后一个字，这样每个字都是某个词的开头。"""
+    if text is None:
+        return None
+    tokens = []
+    for word in _WORD_PTN.findall(text):
+        tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        tokens.append(word[-1])
+    return ' '.join(tokens)
+
+
+# 同步触发器，ensure_index() 在初始化数据库的事务中逐条执行
+_SYNC_STATEMENTS = (
+    # deferred 为 1 时触发器不更新索引，见 deferred_index()
+    '''CREATE TABLE IF NOT EXISTS SearchSync (
+        id integer primary key check (id = 1),
+        deferred integer not null default 0
+    )''',
+    'INSERT OR IGNORE INTO SearchSync(id) VALUES (1)',
+    '''CREATE TRIGGER IF NOT EXISTS Clips_fts_ins AFTER INSERT ON Clips
+    WHEN new.content IS NOT NULL
+    AND NOT (SELECT deferred FROM SearchSync) BEGIN
+        INSERT INTO SearchIndex(rowid, content, bookid)
+        VALUES (new.id, new.content, new.bookid);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS Clips_fts_del AFTER DELETE ON Clips BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id;
+    END''',
+    # 一条笔记可能关联多个标注，只索引其中一行
+    '''CREATE TRIGGER IF NOT EXISTS Notes_fts_ins AFTER INSERT ON Notes
+    WHEN NOT (SELECT deferred FROM SearchSync)
+    AND NOT EXISTS (SELECT 1 FROM Notes WHERE user_id = new.user_id
+                    AND md5 = new.md5 AND id != new.id) BEGIN
+        INSERT INTO SearchIndex(rowid, content, bookid)
+        VALUES (-new.id, new.content, new.bookid);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS Notes_fts_del AFTER DELETE ON Notes BEGIN
+        DELETE FROM SearchIndex WHERE rowid = -old.id;
+    END''',
+    # SearchShort 跟随 SearchIndex
+    '''CREATE TRIGGER IF NOT EXISTS Clips_short_ins AFTER INSERT ON Clips
+    WHEN new.content IS NOT NULL
+    AND NOT (SELECT deferred FROM SearchSync) BEGIN
+        INSERT INTO SearchShort(rowid, tokens, bookid)
+        VALUES (new.id, bigrams(new.content), new.bookid);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS Clips_short_del AFTER DELETE ON Clips BEGIN
+        DELETE FROM SearchShort WHERE rowid = old.id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS Notes_short_ins AFTER INSERT ON Notes
+    WHEN NOT (SELECT deferred FROM SearchSync)
+    AND NOT EXISTS (SELECT 1 FROM Notes WHERE user_id = new.user_id
+                    AND md5 = new.md5 AND id != new.id) BEGIN
+        INSERT INTO SearchShort(rowid, tokens, bookid)
+        VALUES (-new.id, bigrams(new.content), new.bookid);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS Notes_short_del AFTER DELETE ON Notes BEGIN
+        DELETE FROM SearchShort WHERE rowid = -old.id;
+    END''',
+)
+
+
+def ensure_index(conn):
+    """创建 SearchIndex、SearchShort 及同步触发器；新建时用已有的标注和笔记填充。
+    当前SQLite不支持 SEARCH_TOKENIZER 时退回到 unicode61 分词器。
+    """
+    existing = {row[0] for row in conn.execute(
+        "select name from sqlite_master "
+        "where name in ('SearchIndex', 'SearchShort');")}
+    if 'SearchIndex' not in existing:
+        for tokenizer in (SEARCH_TOKENIZER, 'unicode61'):
+            try:
+                conn.execute(
+                    'create virtual table SearchIndex using fts5('
+                    'content, bookid unindexed, tokenize = {!r});'.format(
+                        tokenizer))
+                break
+            except sqlite3.OperationalError:
+                continue
+    if 'SearchShort' not in existing:
+        conn.execute("create virtual table SearchShort using fts5("
+                     "tokens, bookid unindexed, "
+                     "tokenize = 'unicode61 remove_diacritics 0');")
+    for statement in _SYNC_STATEMENTS:
+        conn.execute(statement)
+    if 'SearchIndex' not in existing:
+        _index_since(conn, 0, 0)
+    elif 'SearchShort' not in existing:
+        # 之前建立的数据库只有 SearchIndex
+        conn.execute('INSERT INTO SearchShort(rowid, tokens, bookid) '
+                     'SELECT rowid, bigrams(content), bookid '
+                     'FROM SearchIndex;')
+
+
+def _index_since(conn, clipid, noteid):
+    """将 id 大于 clipid 的标注和 id 大于 noteid 的笔记写入索引。"""
+    conn.execute('INSERT INTO SearchIndex(rowid, content, bookid) '
+                 'SELECT id, content, bookid FROM Clips '
+                 'WHERE id > ? AND content IS NOT NULL;', (clipid,))
+    conn.execute('INSERT INTO SearchIndex(rowid, content, bookid) '
+                 'SELECT -min(id), content, bookid FROM Notes AS n '
+                 'WHERE id > ? AND NOT EXISTS (SELECT 1 FROM Notes '
+                 '    WHERE user_id = n.user_id AND md5 = n.md5 AND id <= ?) '
+                 'GROUP BY user_id, md5;', (noteid, noteid))
+    conn.execute('INSERT INTO SearchShort(rowid, tokens, bookid) '
+                 'SELECT rowid, bigrams(content), bookid FROM SearchIndex '
+                 'WHERE rowid > ? OR rowid < ?;', (clipid, -noteid))
+
+
+@contextmanager
+def deferred_index(conn):
+    """在当前的写事务中暂停触发器对索引的逐行更新，退出时把期间新增的
+    标注和笔记用一条语句写入索引，比逐行插入快一倍左右。
+    标记只在事务内修改，其他连接看不到；事务须在退出之后再提交。
+    """
+    clipid, noteid = conn.execute(
+        'SELECT (SELECT coalesce(max(id), 0) FROM Clips), '
+        '(SELECT coalesce(max(id), 0) FROM Notes);').fetchone()
+    conn.execute('UPDATE SearchSync SET deferred = 1;')
+    try:
+        yield
+    finally:
+        conn.execute('UPDATE SearchSync SET deferred = 0;')
+    with SEARCH_INDEX_SECONDS.time():
+        _index_since(conn, clipid, noteid)
+
+
+def _split_query(query):
+    """将检索词按空白分开，返回 (SearchIndex 的查询, SearchShort 的查询,
+    短词, 需要 LIKE 的短词)：长词组成 FTS5 查询（每个词作为一个短语），
+    由文字组成的短词查询 SearchShort，其余的短词使用 LIKE。"""
+    terms = query.split()
+    long_terms = [t for t in terms if len(t) >= _MIN_TERM]
+    short_terms = [t for t in terms if len(t) < _MIN_TERM]
+    match = ' '.join('"{}"'.format(t.replace('"', '""')) for t in long_terms)
+    indexed = [t for t in short_terms if _WORD_PTN.fullmatch(t)]
+    short_match = ' '.join('"{}"'.format(t) if len(t) > 1 else
+                           '"{}"*'.format(t) for t in indexed)
+    like_terms = [t for t in short_terms if t not in indexed]
+    return match, short_match, short_terms, like_terms
+
+
+def _like(term):
+    return '%{}%'.format(term.replace('\\', '\\\\').replace('%', '\\%')
+                         .replace('_', '\\_'))
+
+
+def _render(text, short_terms):
+    """转义HTML并将标记替换为<mark>，短词在这里补充高亮。"""
+    for term in short_terms:
+        text = text.replace(term, _MARK_L + term + _MARK_R)
+    html = str(escape(text))
+    return Markup(html.replace(_MARK_L, '<mark>').replace(_MARK_R, '</mark>'))
+
+
+def search(conn, query, page=1, per_page=10, user=None):
+    """检索标注和笔记，返回 (总数, 当前页结果)。
+    user 不为None时只检索该用户的书籍。
+    结果按相关度排序（只有短词时按入库顺序），每项包含
+    kind('clip'/'note')、bookid、title、pos、time 和高亮后的 content。
+    """
+    match, short_match, short_terms, like_terms = _split_query(query)
+    if not match and not short_terms:
+        return 0, []
+    if short_match and not conn.execute(
+            "select 1 from sqlite_master where name = 'SearchShort';"
+            ).fetchone():
+        # 之前建立的数据库在下次入库时才会建立 SearchShort
+        short_match, like_terms = '', short_terms
+    # 只有短词时由 SearchShort 检索，否则由 SearchIndex 检索、短词作为过滤条件
+    # （逐行按 rowid 查找 SearchIndex 很慢，常用字可能匹配到两成的记录）
+    table = 'SearchIndex' if match or not short_match else 'SearchShort'
+    like = "content like ? escape '\\'"
+    where, params = [], []
+    if match:
+        where.append('SearchIndex match ?')
+        params.append(match)
+    if short_match:
+        where.append('SearchShort match ?' if table == 'SearchShort' else
+                     'rowid in (select rowid from SearchShort '
+                     'where SearchShort match ?)')
+        params.append(short_match)
+    for term in like_terms:
+        where.append(like if table == 'SearchIndex' else
+                     'rowid in (select rowid from SearchIndex '
+                     'where {})'.format(like))
+        params.append(_like(term))
+    if user is not None:
+        where.append('bookid in (select id from Books where user_id = ?)')
+        params.append(user)
+    where = ' and '.join(where)
+
+    total = conn.execute(
+        'select count(*) from {} where {};'.format(table, where),
+        params).fetchone()[0]
+    if match:
+        content = "highlight(SearchIndex, 0, '{}', '{}')".format(
+            _MARK_L, _MARK_R)
+        order = 'rank'
+    elif table == 'SearchShort':
+        content = ('(select content from SearchIndex '
+                   'where rowid = SearchShort.rowid)')
+        order = 'rowid'
+    else:
+        content, order = 'content', 'rowid'
+    rows = conn.execute(
+        'select r.rid, r.bookid, r.content, b.title, '
+        'coalesce(c.pos, n.pos) as pos, coalesce(c.time, n.time) as time '
+        'from (select rowid as rid, bookid, {content} as content, '
+        '      {order} as ord from {table} where {where} '
+        '      order by ord limit ? offset ?) as r '
+        'join Books as b on b.id = r.bookid '
+        'left join Clips as c on r.rid > 0 and c.id = r.rid '
+        'left join Notes as n on r.rid < 0 and n.id = -r.rid '
+        'order by r.ord;'.format(
+            content=content, table=table, where=where, order=order),
+        params + [per_page, per_page * (page - 1)]).fetchall()
+    results = [{'kind': 'clip' if row['rid'] > 0 else 'note',
+                'bookid': row['bookid'], 'title': row['title'],
+                'pos': row['pos'], 'time': row['time'],
+                'content': _render(row['content'], short_terms)}
+               for row in rows]
+    return total, results
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+users
+-----
+多用户：每个用户的书籍、clips、来源文件的checkpoint和快照互相独立。
+USER_MODE 决定当前用户是谁：
+- None: 单用户，所有数据属于用户 ''（默认，与之前相同）；
+- 'header': 由前面的反向代理完成登录，用户名在 USER_HEADER 请求头中；
+- 'session': 每个浏览器会话一个匿名用户。
+默认所有用户共用 DATABASE 一个文件，各表以 (user_id, ...) 开头的索引分区；
+DATABASE_PER_USER 为 True 时每个用户一个数据库文件，不同用户可以同时入库。
+"""
+import hashlib
+import os
+import secrets
+
+from flask import abort, g, has_request_context, request, session
+
+
+def current_user(config):
+    """当前请求的用户，不在请求中时（例如命令行）为 ''。"""
+    if not has_request_context():
+        return ''
+    if 'user' not in g:
+        mode = config['USER_MODE']
+        if mode == 'header':
+            user = request.headers.get(config['USER_HEADER'], '').strip()
+            if not user:
+                abort(401)
+        elif mode == 'session':
+            user = session.setdefault('user', secrets.token_hex(8))
+        else:
+            user = ''
+        g.user = user
+    return g.user
+
+
+def _digest(user):
+    # 用户名可能包含文件名中不能使用的字符
+    return hashlib.sha1(user.encode('utf-8')).hexdigest()
+
+
+def user_database(user, config):
+    """用户 user 的数据所在的数据库文件。"""
+    if not user or not config['DATABASE_PER_USER']:
+        return config['DATABASE']
+    folder = config['USER_DATABASE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, _digest(user) + '.db')
+
+
+def user_file(path, user):
+    """用户 user 的快照等文件：在扩展名之前加上用户名的摘要。"""
+    if not user:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(root, _digest(user), ext)
@@ -1,22 +1,155 @@
 import re
 import sqlite3
-from config import DATABASE
-from flask import request, url_for
-from pypinyin import lazy_pinyin
+import time
+from bisect import bisect_right
+from itertools import islice
+from operator import itemgetter
+from config import BULK_BATCH_SIZE, BULK_PRAGMAS, DATABASE, DEDUPE_WINDOW
+from db import SCHEMA, execute_script, get_pool
+from dedupe import dedupe_clips, dedupe_notes, superseded
+from metrics import SAVE2DB_SECONDS, Laps
+from search import deferred_index, ensure_index
+from flask import g, request, url_for
 
 
-def save2db(clips):
-    """将解析得到的clips字典对象，保存到数据库中。
-    每次重新上传'My Clippings.txt'时，重新创建数据库里的表。
-    问题：如果要“获取封面”，可以考虑建立一个缓存文件夹，缓存之前已经获取到的封面图片
+# 数据库结构版本，修改 schema.sql 中的表结构时需要加 1
+SCHEMA_VERSION = 8
+TABLES = ('Books', 'Clips', 'Notes', 'Marks', 'Sources', 'Library',
+          'SearchIndex', 'SearchShort', 'SearchSync')
+
+
+def init_schema(conn, rebuild=False):
+    """根据 schema.sql 建表（已存在的表保持不变），并建立全文检索索引。
+    rebuild 为 True，或数据库结构版本与 SCHEMA_VERSION 不一致时，先删除旧表。
+    检查版本和建表在同一个写事务中：两个任务同时初始化一个新数据库时，
+    后一个不会删除前一个刚建好、正在写入的表。
+    """
+    conn.execute('begin immediate;')
+    version = conn.execute('pragma user_version;').fetchone()[0]
+    if rebuild or version != SCHEMA_VERSION:
+        for table in TABLES:
+            conn.execute('drop table if exists {};'.format(table))
+    with open(SCHEMA, 'r') as f:
+        execute_script(conn, f.read())
+    if rebuild or version != SCHEMA_VERSION:
+        bump_generation(conn)
+    # 全文检索索引，由触发器与 Clips/Notes 同步
+    ensure_index(conn)
+    conn.execute('pragma user_version = {};'.format(SCHEMA_VERSION))
+    conn.commit()
+
+
+def clear_user(conn, user):
+    """删除用户 user 的所有书籍和记录。数据库中只有这一个用户时直接重建表，
+    否则逐表删除，触发器同步更新计数和全文检索索引。"""
+    others = conn.execute(
+        "select 1 from sqlite_master where name = 'Library';").fetchone() and \
+        conn.execute('select 1 from Library where user_id != ? limit 1;',
+                     (user,)).fetchone()
+    if not others:
+        init_schema(conn, rebuild=True)
+        return
+    for table in ('Notes', 'Clips', 'Marks', 'Books', 'Sources', 'Library'):
+        conn.execute('delete from {} where user_id = ?;'.format(table),
+                     (user,))
+    bump_generation(conn, user)
+    conn.commit()
+
+
+def bump_generation(conn, user=None):
+    """用户 user（为None时所有用户）的数据发生变化，在写入数据的事务中调用。
+    各进程的页面缓存每次请求都读取版本号，见 cache.py。"""
+    now = time.time()
+    if user is None:
+        conn.execute('update Generations set generation = generation + 1, '
+                     'modified = ?;', (now,))
+        return
+    conn.execute('insert into Generations(user_id, generation, modified) '
+                 'values(?, 1, ?) on conflict(user_id) do update set '
+                 'generation = generation + 1, modified = excluded.modified;',
+                 (user, now))
+
+
+def read_generation(conn, user):
+    """用户 user 的 (数据版本, 修改时间)，还没有数据时为 (0, 0)。"""
+    try:
+        row = conn.execute('select generation, modified from Generations '
+                           'where user_id = ?;', (user,)).fetchone()
+    except sqlite3.OperationalError:
+        # 之前建立的数据库在下次入库时才会建立 Generations
+        return 0, 0
+    return tuple(row) if row else (0, 0)
+
+
+class ClipIntervals(object):
+    """一本书中所有标注的位置区间索引，用于查找覆盖某个笔记位置的标注。
+    区间按 startpos 排序存放在数组中，同时记录最长区间的长度：
+    覆盖 pos 的区间必然满足 pos - maxlen <= startpos <= pos，
+    二分查找出这一段后逐个检查 endpos 即可。
+    """
+    def __init__(self):
+        self._starts = []
+        self._items = []
+        self._maxlen = 0
+        self._sorted = True
+
+    def add(self, start, end, clipid):
+        end = start if end is None else end
+        if self._starts and start < self._starts[-1]:
+            self._sorted = False
+        self._starts.append(start)
+        self._items.append((start, end, clipid))
+        self._maxlen = max(self._maxlen, end - start)
+
+    def covering(self, pos):
+        """返回所有 startpos <= pos <= endpos 的标注id。"""
+        if not self._sorted:
+            self._items.sort()
+            self._starts = [item[0] for item in self._items]
+            self._sorted = True
+        clipids = []
+        idx = bisect_right(self._starts, pos) - 1
+        lower = pos - self._maxlen
+        while idx >= 0 and self._starts[idx] >= lower:
+            start, end, clipid = self._items[idx]
+            if end >= pos:
+                clipids.append(clipid)
+            idx -= 1
+        clipids.reverse()
+        return clipids
+
+
+def _batches(records, size):
+    """将 records 按 size 条一组切分。"""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def save2db(clips, incremental=True, database=None, user='', source=None):
+    """将解析得到的clips保存到数据库中。
+    clips 可以是 ClipsParser.parse() 返回的字典，也可以是
+    ClipsParser.iter_clips() 产出的流，后者逐批写入数据库，内存占用有界。
+    'My Clippings.txt' 只会不断追加，所以默认增量写入：以 clip 的 md5 为唯一键，
+    已存在的书籍和 clip 直接跳过，已获取的封面也得以保留。
+    incremental 为 False 时，先删除该用户已有的数据再全部写入。
+    user 为数据所属的用户，source 为来源文件（设备），都记录在每一行中；
+    不同用户的书籍和clips互不影响，同一用户从多台设备上传的相同clip只存一次。
+    每 BULK_BATCH_SIZE 条记录在一个事务中用 executemany 写入；
+    书籍的id在内存中分配，不需要再从数据库中查询。
+    写入之后，本次涉及的书籍中同一条标注/笔记的旧版本被合并，见 dedupe.py。
     """
     error = None
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    pool = get_pool(database or DATABASE)
+    conn = pool.get()
     cur = conn.cursor()
 
-    with open('schema.sql', 'r') as f:
-        cur.executescript(f.read())
+    init_schema(conn)
+    if not incremental:
+        clear_user(conn, user)
 
     def _sep_t_a(title):
         """将原始title中的作者姓名分离出来。
@@ -39,76 +172,302 @@ def save2db(clips):
                     ptn = ptn[:3] + PTN_L + ptn[3:-2] + PTN_R + ptn[-2:]
         return (title, author)
 
-    def _titles():
-        for title in clips.keys():
-            yield _sep_t_a(title)
+    def _records():
+        """兼容两种输入：parse() 返回的嵌套字典（以16字节的md5为键，
+        或者之前以十六进制md5为键），或 iter_clips() 产出的
+        (bookname, index, clip) 序列。"""
+        if isinstance(clips, dict):
+            for bookname, clipsofonebook in clips.items():
+                for index, clip in clipsofonebook.items():
+                    if isinstance(index, bytes):
+                        index = index.hex()
+                    yield bookname, index, clip
+        else:
+            yield from clips
+
+    def _load_books(maxid):
+        """读取该用户已有书籍的 title -> id，以及（所有用户中）最大的书籍id。"""
+        titles.clear()
+        titles.update(cur.execute(
+            'select title, id from Books where user_id = ?;', (user,)))
+        bookids.clear()
+        lastid[0] = maxid
 
+    def _bookid(bookname, new_books):
+        """返回书籍的id；新书分配下一个id，并加入 new_books 等待写入。"""
+        title, author = _sep_t_a(bookname)
+        bookid = titles.get(title)
+        if bookid is None:
+            lastid[0] += 1
+            bookid = titles[title] = lastid[0]
+            new_books.append((bookid, user, title, author, pinyin_key(title),
+                              title))
+        return bookid
+
+    def _load(batch):
+        """在一个事务中写入一批记录：新书、标注和书签；笔记留到最后再写入。"""
+        lap = Laps(SAVE2DB_SECONDS, 'stage')
+        cur.execute('begin immediate;')
+        # 第一批，或者其他任务在这之间写入了新书时，重新读取书籍的id
+        maxid = cur.execute('select max(id) from Books;').fetchone()[0] or 0
+        if maxid != lastid[0]:
+            _load_books(maxid)
+        new_books, clip_rows, mark_rows = [], [], []
+        for bookname, index, clip in batch:
+            bookid = bookids.get(bookname)
+            if bookid is None:
+                bookid = bookids[bookname] = _bookid(bookname, new_books)
+                touched.add(bookid)
+            # save '标注' clips to Clips table.
+            # warning: the 'content' of '标注' can be 'null' :<
+            if clip['type'] == '标注':
+                clip_rows.append((index, clip['pos'], clip['start_pos'],
+                                  clip['end_pos'], clip['time'],
+                                  clip['content'], bookid, user, source))
+            # save '书签' clips to Marks table.
+            elif clip['type'] == '书签':
+                mark_rows.append((index, clip['pos'], clip['start_pos'],
+                                  clip['end_pos'], clip['time'], bookid,
+                                  user, source))
+            else:
+                # 笔记需要关联到标注上，等所有标注存入后再处理
+                notes.append((bookid, index, clip))
+        if DEDUPE_WINDOW is not None:
+            # 同一批中被新版本取代的标注不再写入
+            old = superseded(clip_rows, DEDUPE_WINDOW, itemgetter(6, 2, 3, 4))
+            if old:
+                clip_rows = [row for i, row in enumerate(clip_rows)
+                             if i not in old]
+        lap('prepare')
+        # 之前获取过的封面直接从 Covers 缓存中取得
+        cur.executemany(
+            'insert into Books(id, user_id, title, author, titlekey, cover) '
+            'values(?, ?, ?, ?, ?, '
+            '(select filename from Covers where title = ?));',
+            new_books)
+        lap('books')
+        # 全文索引在每批写入之后一次性更新
+        with deferred_index(conn):
+            # 该用户已存入的 clip（md5 相同）由唯一索引 (user_id, md5) 忽略。
+            cur.executemany(
+                'insert or ignore into Clips(md5, pos, startpos, endpos, '
+                'time, content, bookid, user_id, source_id) '
+                'values(?, ?, ?, ?, ?, ?, ?, ?, ?);', clip_rows)
+            cur.executemany(
+                'insert or ignore into Marks(md5, pos, startpos, endpos, '
+                'time, bookid, user_id, source_id) '
+                'values(?, ?, ?, ?, ?, ?, ?, ?);', mark_rows)
+        lap('clips')
+        bump_generation(conn, user)
+        conn.commit()
+        lap('commit')
+
+    def _dedupe_clips():
+        """所有标注存入之后，合并本次涉及的书籍中跨批次、跨上传的重复标注。"""
+        if DEDUPE_WINDOW is None or not touched:
+            return
+        lap = Laps(SAVE2DB_SECONDS, 'stage')
+        cur.execute('begin immediate;')
+        if dedupe_clips(conn, sorted(touched), DEDUPE_WINDOW):
+            bump_generation(conn, user)
+        conn.commit()
+        lap('dedupe')
+
+    def _existing_notes(md5s):
+        """返回 md5s 中该用户已经存入Notes表的md5。"""
+        md5s = list(md5s)
+        existing = set()
+        for i in range(0, len(md5s), 500):
+            part = md5s[i:i + 500]
+            cur.execute('select md5 from Notes where user_id = ? and '
+                        'md5 in ({});'.format(', '.join('?' * len(part))),
+                        [user] + part)
+            existing.update(row[0] for row in cur)
+        return existing
+
+    def _intervals(bookid):
+        """返回书籍的标注区间索引，从数据库中一次性读取。"""
+        if bookid not in intervals:
+            index = intervals[bookid] = ClipIntervals()
+            cur.execute('select startpos, endpos, id from Clips '
+                        'where bookid = ? order by startpos;', (bookid,))
+            for start, end, clipid in cur:
+                index.add(start, end, clipid)
+        return intervals[bookid]
+
+    def _load_notes():
+        """所有标注存入之后，在一个事务中写入笔记。"""
+        if not notes:
+            return
+        lap = Laps(SAVE2DB_SECONDS, 'stage')
+        cur.execute('begin immediate;')
+        seen = _existing_notes({index for _, index, _ in notes})
+        rows = []
+        for bookid, index, clip in notes:
+            if index in seen:
+                continue
+            seen.add(index)
+            # one '笔记' may belongs to many '标注' of the same book
+            for clipid in _intervals(bookid).covering(clip['start_pos']):
+                rows.append((index, clip['pos'], clip['time'],
+                             clip['content'], bookid, clipid, user, source))
+        with deferred_index(conn):
+            cur.executemany(
+                'insert or ignore into Notes(md5, pos, time, content, bookid, '
+                'clipid, user_id, source_id) values(?, ?, ?, ?, ?, ?, ?, ?);',
+                rows)
+        lap('notes')
+        if DEDUPE_WINDOW is not None:
+            dedupe_notes(conn, sorted({bookid for bookid, _, _ in notes}),
+                         DEDUPE_WINDOW)
+            lap('dedupe')
+        bump_generation(conn, user)
+        conn.commit()
+        lap('commit')
+
+    # 入库期间使用 BULK_PRAGMAS，结束后恢复原来的设置
+    pragmas = {}
+    for name, value in BULK_PRAGMAS.items():
+        pragmas[name] = cur.execute('pragma {};'.format(name)).fetchone()[0]
+        cur.execute('pragma {} = {};'.format(name, value))
     try:
-        # 将书籍名称存入Books表中
-        cur.executemany('insert into Books(title, author) values(?, ?);',
-                        _titles())
-        # Insert values into Clips, Notes, Marks tables.
-        for title, clipsofonebook in clips.items():
-            title, _ = _sep_t_a(title)
-            cur.execute('select id from Books where title = ?;', (title,))
-            bookid = cur.fetchone()[0]
-            notes = []
-            for clip in clipsofonebook.values():
-                # save '标注' clips to Clips table.
-                # warning: the 'content' of '标注' can be 'null' :<
-                if clip['type'] == '标注':
-                    cur.execute(
-                        'insert into Clips values(null, ?, ?, ?, ?, ?, ?);',
-                        (clip['pos'], clip['start_pos'], clip['end_pos'],
-                            clip['time'], clip['content'], bookid))
-                # save '书签' clips to Marks table.
-                elif clip['type'] == '书签':
-                    cur.execute(
-                        'insert into Marks values(null, ?, ?, ?, ?, ?);',
-                        (clip['pos'], clip['start_pos'], clip['end_pos'],
-                            clip['time'], bookid))
-                else:
-                    notes.append(clip)
-            # save '笔记' clips to Notes table.
-            if notes:
-                for clip in notes:
-                    # one '笔记' may belongs to many '标注'
-                    cur.execute(
-                        'select id from Clips where startpos <= ? '
-                        'and endpos >= ?;',
-                        (clip['start_pos'], clip['start_pos']))
-                    clipids = cur.fetchall()
-                    for clipid in clipids:
-                        cur.execute(
-                            'insert into Notes values(null, ?, ?, ?, ?, ?);',
-                            (clip['pos'], clip['time'], clip['content'],
-                                bookid, clipid[0]))
+        # title -> Books.id，bookname -> Books.id
+        titles, bookids = {}, {}
+        lastid = [None]
+        # Books.id -> ClipIntervals
+        intervals = {}
+        notes = []
+        # 本次写入了记录的书籍
+        touched = set()
+        for batch in _batches(_records(), BULK_BATCH_SIZE):
+            _load(batch)
+        _dedupe_clips()
+        _load_notes()
     except sqlite3.Error as e:
         conn.rollback()
         error = ('Failed to save data to database :(, {}'.format(e))
-    conn.commit()
-    conn.close()
+    finally:
+        for name, value in pragmas.items():
+            cur.execute('pragma {} = {};'.format(name, value))
+        pool.put(conn)
     return error
 
 
-def collate_pinyin(t1, t2):
-    """collation function, working with 'order by' in sql statement,
-    making it possible to order by chinese characters.
+def load_checkpoint(source, user='', database=None):
+    """返回用户 user 的来源文件 source 上次解析的 checkpoint (offset, prefix_md5)，
+    没有则返回None。
+    """
+    with get_pool(database or DATABASE).connection() as conn:
+        init_schema(conn)
+        row = conn.execute('select offset, md5 from Sources '
+                           'where user_id = ? and source = ?;',
+                           (user, source)).fetchone()
+    return tuple(row) if row else None
+
+
+def save_checkpoint(source, checkpoint, user='', database=None):
+    """保存用户 user 的来源文件 source 的 checkpoint，
+    须在该文件的clips全部入库之后调用。
+    """
+    if not checkpoint:
+        return
+    with get_pool(database or DATABASE).connection() as conn:
+        conn.execute('insert or replace into Sources(user_id, source, offset, '
+                     'md5) values(?, ?, ?, ?);',
+                     (user, source) + tuple(checkpoint))
+        conn.commit()
+
+
+def pinyin_key(title):
+    """拼音排序键，入库时计算并存入Books.titlekey，
+    书籍列表直接按该列的索引排序，不需要在查询时调用Python函数。
+    pypinyin 的字典很大，导入需要约0.2秒，所以第一次调用时才导入。
+    """
+    from pypinyin import lazy_pinyin
+
+    return ''.join(lazy_pinyin(title))
+
+
+def fetch_page(cur, table, key, page, per_page, page_name='page',
+               where='1', params=(), outer=None):
+    """分页查询 table 中按 key（例如 ('startpos', 'id')）排序的第 page 页。
+    如果请求中带有上一页/下一页的游标参数（<page_name>_after /
+    <page_name>_before，值为相邻页边界记录的id），就从游标处沿索引向后/向前
+    读取 per_page 条记录（keyset分页），与页码深浅无关；
+    直接跳到某一页时才退回到 limit/offset。
+    outer 是可选的外层查询，'{}' 处替换为分页子查询，须保留 id 列并自行排序。
+    """
+    asc = ', '.join(key)
+    if outer is None:
+        outer = 'select * from ({{}}) order by {};'.format(asc)
+    cursor = None
+    for direction in ('after', 'before'):
+        value = request.args.get('{}_{}'.format(page_name, direction),
+                                 type=int)
+        if value is not None:
+            cursor = (direction, value)
+            break
+
+    rows = []
+    if cursor:
+        op, order = ('>', asc) if cursor[0] == 'after' else \
+            ('<', ', '.join(k + ' desc' for k in key))
+        inner = ('select * from {t} where {w} and ({k}) {op} '
+                 '(select {k} from {t} where id = ?) order by {o} limit ?'
+                 ).format(t=table, w=where, k=asc, op=op, o=order)
+        cur.execute(outer.format(inner), tuple(params) + (cursor[1], per_page))
+        rows = cur.fetchall()
+    if not rows:
+        # 没有游标，或者游标对应的记录已不存在
+        inner = ('select * from {t} where {w} order by {k} limit ? offset ?'
+                 ).format(t=table, w=where, k=asc)
+        cur.execute(outer.format(inner),
+                    tuple(params) + (per_page, per_page * (page - 1)))
+        rows = cur.fetchall()
+
+    if rows:
+        if not hasattr(g, 'page_cursors'):
+            g.page_cursors = {}
+        g.page_cursors[page_name] = (page, rows[0]['id'], rows[-1]['id'])
+    return rows
+
+
+def fetch_after(cur, table, key, after, limit, where='1', params=(),
+                outer=None):
+    """按 key 排序，读取 id 为 after 的记录之后的 limit 条记录（keyset分页），
+    after 为None时从头开始；after 对应的记录已不存在时返回空列表。
+    用于滚动加载，参数同 fetch_page()。
     """
-    py_t1 = ''.join(lazy_pinyin(t1))
-    py_t2 = ''.join(lazy_pinyin(t2))
-    if py_t1 == py_t2:
-        return 0
-    elif py_t1 < py_t2:
-        return -1
+    asc = ', '.join(key)
+    if outer is None:
+        outer = 'select * from ({{}}) order by {};'.format(asc)
+    if after is None:
+        inner = 'select * from {t} where {w} order by {k} limit ?'.format(
+            t=table, w=where, k=asc)
+        args = tuple(params) + (limit,)
     else:
-        return 1
+        inner = ('select * from {t} where {w} and ({k}) > '
+                 '(select {k} from {t} where id = ?) order by {k} limit ?'
+                 ).format(t=table, w=where, k=asc)
+        args = tuple(params) + (after, limit)
+    cur.execute(outer.format(inner), args)
+    return cur.fetchall()
 
 
 def url_for_page(page, page_name):
     """used in pagination, to get the url for next or pre page.
+    Links to the adjacent pages carry a keyset cursor set by fetch_page().
     """
     kwargs = request.view_args.copy()
     kwargs.update(request.args.to_dict())
     kwargs[page_name] = page
+    kwargs.pop(page_name + '_after', None)
+    kwargs.pop(page_name + '_before', None)
+    current, first_id, last_id = \
+        getattr(g, 'page_cursors', {}).get(page_name, (None, None, None))
+    if current is not None:
+        if page == current + 1:
+            kwargs[page_name + '_after'] = last_id
+        elif page == current - 1:
+            kwargs[page_name + '_before'] = first_id
     return url_for(request.endpoint, **kwargs)